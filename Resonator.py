@@ -1,4 +1,5 @@
 import gdstk
+from layout import CapacitorLayout, cached_cell
 import warnings
 
 def feedline(**kwargs):
@@ -44,6 +45,7 @@ def feedline(**kwargs):
     return cell
 
 
+@cached_cell
 def capacitor(**kwargs):
 
     cell = gdstk.Cell(kwargs.get("name", "capacitor"))
@@ -60,7 +62,6 @@ def capacitor(**kwargs):
 
     # Capacitor parameters
     finger_pairs = 7
-    fingers = 2 * finger_pairs
     finger_gap = kwargs.get("finger_gap", 2)
     finger_width = kwargs.get("finger_width", 2)
     coupling_bar_gap = kwargs.get("coupling_bar_gap", 0.5)
@@ -71,57 +72,22 @@ def capacitor(**kwargs):
     bar_width = kwargs.get("bar_width", 400)  # this is the length of the bottom bar
     coupling_bar_height_max = cavity_height - 2 * coupling_bar_gap  # sets the height of the coupling bar within the cavity in the feedline
     coupling_bar_height = kwargs.get('coupling_bar_height',0)
-    right_bar_width = bar_width - left_bar_width - bar_gap
 
     #### capacitor geometry ####
+    layout = CapacitorLayout(ground1_width, gap, center_width, ground2_width, bottom_ground_height,
+                             coupling_bar_gap, coupling_bar_width, coupling_bar_height_max, left_bar_width,
+                             bar_gap, bar_height, bar_width, finger_gap, finger_width, finger_pairs)
+
     # this is the coupling bar at the origin
-    coupling_bar = gdstk.rectangle((ground1_width + gap + center_width + gap + ground2_width + coupling_bar_gap,
-                                    bottom_ground_height + coupling_bar_gap + coupling_bar_height_max),
-                                   (
-                                       ground1_width + gap + center_width + gap + ground2_width + coupling_bar_gap + coupling_bar_width,
-                                       bottom_ground_height + coupling_bar_gap + coupling_bar_height))
-    cell.add(coupling_bar)
-
-    # this is the left bar that forms the partial boundry of the interdigited capacitor
-    path = gdstk.FlexPath(
-        (ground1_width + gap + center_width + gap + ground2_width + coupling_bar_gap + coupling_bar_width,
-         bottom_ground_height + coupling_bar_gap + coupling_bar_height_max / 2 - bar_height / 2), bar_height)
-    path = path.horizontal(
-        ground1_width + gap + center_width + gap + ground2_width + coupling_bar_gap + coupling_bar_width + left_bar_width,
-        bar_height)
-    cell.add(path)
+    cell.add(layout.coupling_bar(coupling_bar_height))
 
-    # #right capacitor bar
-    path = gdstk.FlexPath((
-        ground1_width + gap + center_width + gap + ground2_width + coupling_bar_gap + coupling_bar_width + left_bar_width + bar_gap,
-        bottom_ground_height + coupling_bar_gap + coupling_bar_height_max / 2 - bar_height / 2),
-        bar_height)
-    path = path.horizontal(
-        ground1_width + gap + center_width + gap + ground2_width + coupling_bar_gap + coupling_bar_width + left_bar_width + bar_gap + right_bar_width + bar_height / 2,
-        bar_height)
-    path = path.vertical(
-        bottom_ground_height + coupling_bar_gap + coupling_bar_height_max / 2 + fingers * (finger_gap + finger_width))
-    cell.add(path)
+    # these are the left and right bars that form the boundry of the interdigited capacitor
+    cell.add(*layout.bars())
 
     # these rectangles are used to transition into the inductor
-    patch1 = gdstk.rectangle((
-        ground1_width + gap + center_width + gap + ground2_width + coupling_bar_gap + coupling_bar_width + left_bar_width,
-        bottom_ground_height + coupling_bar_gap + coupling_bar_height_max / 2 - bar_height),
-        (
-            ground1_width + gap + center_width + gap + ground2_width + coupling_bar_gap + coupling_bar_width + left_bar_width - bar_height,
-            bottom_ground_height + coupling_bar_gap + coupling_bar_height_max / 2 - bar_height - spacing_between_inductor_waveguide - inductor_width))
-
-    patch2 = gdstk.rectangle((
-        ground1_width + gap + center_width + gap + ground2_width + coupling_bar_gap + coupling_bar_width + left_bar_width + bar_gap,
-        bottom_ground_height + coupling_bar_gap + coupling_bar_height_max / 2 - bar_height),
-        (
-            ground1_width + gap + center_width + gap + ground2_width + coupling_bar_gap + coupling_bar_width + left_bar_width + bar_gap + bar_height,
-            bottom_ground_height + coupling_bar_gap + coupling_bar_height_max / 2 - bar_height - spacing_between_inductor_waveguide - inductor_width))
-    cell.add(patch1)
-    cell.add(patch2)
+    cell.add(*layout.patches(spacing_between_inductor_waveguide, inductor_width))
 
     # Define capacitor fingers
-    used_fill = 0
     total_fill = (bar_width - finger_gap) * finger_pairs # sets the fill we want the sum of our fingers to have
     fill = kwargs.get('fill', total_fill)
 
@@ -149,27 +115,8 @@ def capacitor(**kwargs):
     #         message = "The 'fill' parameter should be positive."
     #     warnings.warn(message, RuntimeWarning)
 
-    direction = -1
-    position = bottom_ground_height + coupling_bar_gap + coupling_bar_height_max/2 + finger_gap
-    finger_space = finger_width
-    fingerss = []
-    for _ in range(finger_pairs):
-        added_fill = min(max_fill, fill - used_fill)
-        if added_fill < base_fill:
-            added_fill = base_fill
-        used_fill += added_fill
-        for i in range(2):
-            direction *= -1
-            start = ground1_width + gap + center_width + gap + ground2_width + coupling_bar_gap + coupling_bar_width \
-                if i % 2 == 0 else ground1_width + gap + center_width + gap + ground2_width + coupling_bar_gap + coupling_bar_width + bar_width
-            stop = start + direction * added_fill if i % 2 == 0 \
-                else ground1_width + gap + center_width + gap + ground2_width + coupling_bar_gap + coupling_bar_width + bar_width + direction * added_fill
-            fingerss.append(gdstk.rectangle(
-                (start, position), (stop - finger_space, position + finger_width)))
-            position += (finger_gap + finger_width)
-            finger_space *= -1
-
-    cell.add(*fingerss)
+    added_fill = layout.added_fill(fill, base_fill, max_fill)
+    cell.add(*layout.finger_polygons(added_fill))
 
     return cell
 
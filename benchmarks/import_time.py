@@ -0,0 +1,50 @@
+# Import time of the sweep and array modules measured with python -X importtime.
+# Each run appends one row per module to benchmarks/import_time.csv so the
+# numbers can be compared between releases.
+#   python benchmarks/import_time.py [label]
+import sys
+import csv
+import datetime
+import pathlib
+import subprocess
+
+directory = pathlib.Path(__file__).parents[1]
+history = pathlib.Path(__file__).parent / "import_time.csv"
+modules = ["Resonator", "final_array", "current", "simulation", "fitting", "scheduler", "fine_grid"]
+
+
+def import_time(module):
+    # cumulative import time of 'module' in microseconds (None if it fails to import)
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                             cwd=directory, capture_output=True, text=True)
+    if process.returncode != 0:
+        return None
+    for line in process.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = line.removeprefix("import time:").split("|")
+        if len(fields) == 3 and fields[2] == f" {module}":  # the top level import
+            return int(fields[1])
+    return None
+
+
+def label():
+    process = subprocess.run(["git", "describe", "--tags", "--always", "--dirty"],
+                             cwd=directory, capture_output=True, text=True)
+    return process.stdout.strip() or "unknown"
+
+
+if __name__ == "__main__":
+    release = sys.argv[1] if len(sys.argv) > 1 else label()
+    date = datetime.date.today().isoformat()
+    new = not history.is_file()
+    with open(history, "a", newline="") as f:
+        writer = csv.writer(f)
+        if new:
+            writer.writerow(["release", "date", "python", "module", "cumulative_us"])
+        for module in modules:
+            microseconds = import_time(module)
+            shown = "failed" if microseconds is None else f"{microseconds / 1e3:.1f} ms"
+            print(f"{module:12s} {shown}")
+            if microseconds is not None:
+                writer.writerow([release, date, f"{sys.version_info[0]}.{sys.version_info[1]}",
+                                 module, microseconds])
@@ -0,0 +1,28 @@
+# Per-pixel cost of setting up the sonnet project with and without the
+# project template (nothing is written or simulated).
+#   python benchmarks/project_setup.py [pixels]
+import sys
+import time
+import pathlib
+
+sys.path.insert(0, str(pathlib.Path(__file__).parents[1]))
+
+from Resonator import capacitor  # noqa: E402
+from simulation import single_pixel  # noqa: E402
+
+
+def per_pixel(template, pixels):
+    capacitor.cache_clear()  # don't let the geometry cache favour the second run
+    start = time.perf_counter()
+    for index in range(pixels):
+        cap = dict(fill=1950 - 10 * index, coupling_bar_height=0.5 * (index % 92))
+        single_pixel(f"benchmark_{index}", epsilon=9.3, capacitor_kwargs=cap, save=False, template=template)
+    return (time.perf_counter() - start) / pixels
+
+
+if __name__ == "__main__":
+    pixels = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    rebuild = per_pixel(False, pixels)
+    template = per_pixel(True, pixels)
+    print(f"rebuild:  {rebuild * 1e3:.2f} ms per pixel")
+    print(f"template: {template * 1e3:.2f} ms per pixel ({rebuild / template:.1f}x)")
@@ -0,0 +1,135 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import pathlib
+import numpy as np
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+directory = pathlib.Path(__file__).parent.absolute()
+
+
+def simulation_key(cells, **settings):
+    # Hash the generated polygons together with the solver settings. The cells
+    # are given as (tech_layer, cell) pairs so that moving a polygon from one
+    # metal to another changes the key.
+    digest = hashlib.sha256()
+    for tech_layer, cell in cells:
+        digest.update(tech_layer.encode())
+        for polygon in cell.get_polygons():
+            digest.update(f"{polygon.layer}/{polygon.datatype}".encode())
+            points = np.round(np.asarray(polygon.points, dtype=float), 6) + 0.0  # + 0.0 drops -0.0
+            digest.update(np.ascontiguousarray(points).tobytes())
+    digest.update(json.dumps(settings, sort_keys=True, default=float).encode())
+    return digest.hexdigest()
+
+
+def key_file(output_file, suffix=".key"):
+    # The key of the inputs that produced a touchstone file is kept next to it.
+    # The ".solved" file records the inputs the .son project itself was
+    # solved for, a restored touchstone file comes without the solution data.
+    output_file = pathlib.Path(output_file)
+    return output_file.parent / (output_file.stem + suffix)
+
+
+def read_key(output_file, suffix=".key"):
+    file = key_file(output_file, suffix)
+    if not file.is_file():
+        return None
+    return file.read_text().strip()
+
+
+def write_key(output_file, key, suffix=".key"):
+    key_file(output_file, suffix).write_text(key)
+
+
+def clear_keys(output_file):
+    # forget the inputs of a file that is rewritten outside of the cache
+    for suffix in (".key", ".solved"):
+        key_file(output_file, suffix).unlink(missing_ok=True)
+
+
+def write_solved(output_file, key, frequencies):
+    # record the frequencies (GHz) em analysed when solving the project of 'output_file'
+    with open(key_file(output_file, ".solved"), "w") as f:
+        json.dump(dict(key=key, frequencies=sorted(frequencies)), f)
+
+
+def solved_frequencies(output_file):
+    # The frequencies at which the .son project of 'output_file' holds the
+    # solution (and current density) of its current result. None if the
+    # project was not solved here or the frequencies are not known.
+    output_file = pathlib.Path(output_file)
+    file = key_file(output_file, ".solved")
+    if not (output_file.is_file() and output_file.with_suffix(".son").is_file() and file.is_file()):
+        return None
+    with open(file) as f:
+        record = json.load(f)
+    if record['key'] != read_key(output_file):
+        return None
+    return record['frequencies'] or None
+
+
+def _copy(source, destination):
+    # copy through a temporary file so readers never see a partial file
+    temporary = destination.parent / f".{destination.name}.{os.getpid()}.tmp"
+    shutil.copyfile(source, temporary)
+    os.replace(temporary, destination)
+
+
+class SimulationCache:
+    def __init__(self, folder="sonnet/cache"):
+        self.folder = directory / pathlib.Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+
+    def touchstone(self, key):
+        return self.folder / f"{key}.ts"
+
+    def __contains__(self, key):
+        return self.touchstone(key).is_file()
+
+    def restore(self, key, output_file):
+        # Put the cached result for 'key' at 'output_file'. Returns False if
+        # nothing is cached. An existing file is only trusted if it was
+        # produced from the same inputs.
+        output_file = pathlib.Path(output_file)
+        if output_file.is_file() and read_key(output_file) == key:
+            return True
+        if key not in self:
+            return False
+        output_file.parent.mkdir(parents=True, exist_ok=True)
+        _copy(self.touchstone(key), output_file)
+        write_key(output_file, key)
+        log.info(f"Restored {output_file.name} from the simulation cache")
+        return True
+
+    def store(self, key, output_file):
+        output_file = pathlib.Path(output_file)
+        _copy(output_file, self.touchstone(key))
+        write_key(output_file, key)
+
+    def load_fit(self, key):
+        file = self.folder / f"{key}.json"
+        if not file.is_file():
+            return None
+        with open(file) as f:
+            return json.load(f)
+
+    def store_fit(self, key, result):
+        # only the scalar entries of the loopfit result are kept
+        scalars = {}
+        for k, value in result.items():
+            if isinstance(value, (bool, np.bool_)):
+                scalars[k] = bool(value)
+            elif isinstance(value, (int, float, np.integer, np.floating)):
+                scalars[k] = float(value)
+            elif isinstance(value, str):
+                scalars[k] = value
+        file = self.folder / f"{key}.json"
+        temporary = file.parent / f".{file.name}.{os.getpid()}.tmp"
+        with open(temporary, "w") as f:
+            json.dump(scalars, f)
+        os.replace(temporary, file)
@@ -1,22 +1,18 @@
 import logging
 import pathlib
+import csv
+import json
+import hashlib
+import functools
 import numpy as np
-from pysonnet import outputs
 import xml.etree.ElementTree as ET
-from xml.dom import minidom
-import psutil
 import os
-import subprocess
 
 log = logging.getLogger(__name__)
 
 
-def export_current_density(folder, **kwargs):
-
-    directory = pathlib.Path(__file__).parent.absolute()
-
-    # xml file name
-    xml_name = kwargs.get('xml_name', 'test')
+def _jxy_export(export_set, **kwargs):
+    # add one JXY_Export element to a JXY_Export_Set
 
     # define csv filename to be exported
     csv_name = kwargs.get('csv_name', "current1.csv")
@@ -62,11 +58,9 @@ def export_current_density(folder, **kwargs):
     frequency = kwargs.get('frequency', "6000000000") # freq must be in Hz
 
 
-    # xml file generation
-
-    JXY_Export_Set = ET.Element("JXY_Export_Set")
+    # xml element generation
 
-    JXY_Export = ET.SubElement(JXY_Export_Set, "JXY_Export", Filename=csv_name, Label=son_label)
+    JXY_Export = ET.SubElement(export_set, "JXY_Export", Filename=csv_name, Label=son_label)
 
     ET.SubElement(JXY_Export, "Region", Style=region_style, Left=left, Right=right, Top=top, bottom=bottom)
     ET.SubElement(JXY_Export, "Levels", Stop=levels_stop, Range=levels_range, Start=levels_start)
@@ -88,43 +82,171 @@ def export_current_density(folder, **kwargs):
 
     ET.SubElement(Locator, "Frequency", Value=frequency)
 
-    tree = ET.ElementTree(JXY_Export_Set)
-    tree.write(xml_name + '.xml', encoding='utf-8', xml_declaration=True)
+    return JXY_Export
+
+
+def _jxy_command(folder, xml_name, son_label, exports):
+    # write the JXY_Export_Set for 'exports' and return the soncmd command that runs it
+    from xml.dom import minidom  # delay minidom import
+    import runner
+    directory = pathlib.Path(__file__).parent.absolute()
+
+    JXY_Export_Set = ET.Element("JXY_Export_Set")
+    for export in exports:
+        _jxy_export(JXY_Export_Set, **export)
 
     #turns the xml file into the prettyprint format needed for sonnet
     xmlstr = minidom.parseString(ET.tostring(JXY_Export_Set)).toprettyxml(indent="\t", encoding='utf-8')
 
-    # move to the folder with .son file.
-    # One problem is that the original tree.write file also exists so I need to delete that one in the process
+    # write it to the folder with .son file.
     directed_xml = os.path.join(directory / folder, xml_name + '.xml')
     with open(directed_xml, "wb") as f:
         f.write(xmlstr)
 
     # path to soncmd
-    soncmd_path = os.path.join('/opt/sonnet', 'bin', 'soncmd')
+    soncmd_path = os.path.join(runner.sonnet_path, 'bin', 'soncmd')
 
     # specify where the sonnet file lives
     son_label = os.path.join(directory / folder / son_label)
     # collect the command to run
-    command = [soncmd_path, '-JXYExport', directed_xml, son_label]
-
-    with psutil.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as process:
-        while True:
-            output = process.stdout.readline().decode('utf-8').strip()
-            error = process.stderr.readline().decode('utf-8').strip()
-            if not output and not error and process.poll() is not None:
-                break
-            if output:
-                log.info(output)
-            if error:
-                log.error(error)
-
-    # remove the original xml file
-    os.remove(xml_name + '.xml')
+    return [soncmd_path, '-JXYExport', directed_xml, son_label]
 
 
-
-def compute_uniformity_single(name):
+def export_current_density(folder, timeout=None, **kwargs):
+    # export the current density of one sonnet file (see _jxy_export for the keywords)
+    import runner  # delay psutil import
+    xml_name = kwargs.get('xml_name', 'test')
+    son_label = kwargs.get('son_label', "current1.son")
+    # a failed export raises instead of leaving a missing or stale csv behind
+    return runner.check(runner.run(_jxy_command(folder, xml_name, son_label, [kwargs]), timeout=timeout,
+                                   logger=log))
+
+
+def export_current_density_batch(exports, workers=1, timeout=None):
+    # Export many current densities at once. Each entry of 'exports' holds the
+    # export_current_density keywords, including 'folder'. Exports from the
+    # same sonnet file share one JXY_Export_Set and one soncmd run, and up to
+    # 'workers' soncmd runs go at the same time. Returns the error of every
+    # export (None if it succeeded) in the order of 'exports'.
+    import runner  # delay psutil import
+    groups = {}  # (folder, son_label) -> indices into 'exports'
+    for index, export in enumerate(exports):
+        key = (pathlib.Path(export['folder']), export.get('son_label', "current1.son"))
+        groups.setdefault(key, []).append(index)
+
+    commands = []
+    for (folder, son_label), indices in groups.items():
+        group = [{k: v for k, v in exports[index].items() if k != 'folder'} for index in indices]
+        xml_name = group[0].get('xml_name', pathlib.Path(son_label).stem + "_jxy")
+        commands.append(_jxy_command(folder, xml_name, son_label, group))
+    results = runner.run_many(commands, limit=workers, timeout=timeout, logger=log, return_exceptions=True)
+
+    errors = [None] * len(exports)
+    for indices, result in zip(groups.values(), results):
+        if not isinstance(result, Exception):
+            try:
+                runner.check(result)
+            except RuntimeError as error:
+                result = error
+        if isinstance(result, Exception):
+            for index in indices:
+                errors[index] = result
+    return errors
+
+
+def load_current_density(file, rows=None, columns=None):
+    # Stream a Sonnet JXY csv export and keep only the grid cells in
+    # rows[0]:rows[1] and columns[0]:columns[1] (the whole grid by default).
+    # The grid is written as a row of x positions followed by one row per y
+    # position starting with its y value; anything above it is a header.
+    # Returns the cropped current density as float32 and the grid steps.
+    row_start, row_stop = rows if rows is not None else (0, None)
+    column_start, column_stop = columns if columns is not None else (0, None)
+    x = None
+    y = []
+    jd = []
+
+    def numeric(cell):
+        try:
+            float(cell)
+        except ValueError:
+            return False
+        return True
+
+    with open(file, newline='') as f:
+        for line in csv.reader(f):
+            if x is None:
+                # the x positions follow a (possibly empty) leading label cell
+                values = [cell for cell in line[1:] if cell.strip()]
+                if len(values) > 1 and all(numeric(cell) for cell in values):
+                    x = np.array(values, dtype=float)
+                continue
+            if not line or not numeric(line[0]):
+                continue
+            index = len(y)
+            y.append(float(line[0]))
+            if index >= row_start and (row_stop is None or index < row_stop):
+                cells = line[1:1 + x.size][column_start:column_stop]
+                jd.append(np.array(cells, dtype=np.float32))
+            elif row_stop is not None and index >= row_stop and len(y) > 1:
+                break  # the rest of the file is outside of the region
+
+    if x is None:
+        raise ValueError(f"No current density grid found in {file}")
+    dx = abs(x[1] - x[0])
+    dy = abs(y[1] - y[0]) if len(y) > 1 else dx
+    return np.stack(jd), dx, dy
+
+
+def _file_hash(file):
+    digest = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_current_density_cached(file, rows=None, columns=None):
+    # Same as load_current_density but the parsed grid is kept next to the
+    # csv as a .npy file (memory-mapped on later loads) with a .json file of
+    # its metadata. The cache is used if it holds the same region and the csv
+    # has the same mtime and size, or the same hash if only those changed.
+    file = pathlib.Path(file)
+    grid_file = file.parent / (file.stem + ".jxy.npy")
+    meta_file = file.parent / (file.stem + ".jxy.json")
+    stat = file.stat()
+    region = dict(rows=list(rows) if rows is not None else None,
+                  columns=list(columns) if columns is not None else None)
+
+    if grid_file.is_file() and meta_file.is_file():
+        with open(meta_file) as f:
+            meta = json.load(f)
+        valid = meta['region'] == region
+        if valid and (meta['mtime_ns'], meta['size']) != (stat.st_mtime_ns, stat.st_size):
+            valid = meta['sha256'] == _file_hash(file)
+            if valid:  # the file was touched but not changed
+                meta.update(mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+                with open(meta_file, 'w') as f:
+                    json.dump(meta, f)
+        if valid:
+            return np.load(grid_file, mmap_mode='r'), meta['dx'], meta['dy']
+
+    jd, dx, dy = load_current_density(file, rows=rows, columns=columns)
+    meta = dict(dx=float(dx), dy=float(dy), region=region, mtime_ns=stat.st_mtime_ns,
+                size=stat.st_size, sha256=_file_hash(file))
+    # write through temporary files so a reader never sees a partial cache
+    temporary = grid_file.parent / f".{grid_file.name}.{os.getpid()}.tmp"
+    with open(temporary, 'wb') as f:
+        np.save(f, jd)
+    os.replace(temporary, grid_file)
+    temporary = meta_file.parent / f".{meta_file.name}.{os.getpid()}.tmp"
+    with open(temporary, 'w') as f:
+        json.dump(meta, f)
+    os.replace(temporary, meta_file)
+    return jd, dx, dy
+
+
+def compute_uniformity_single(name, rows=None, columns=None, cache=True):
 
     # the width w(x) is proportional to J(x)
     # we want to solve for a constant 'a' that equates w(x) = a J(x)
@@ -138,52 +260,70 @@ def compute_uniformity_single(name):
     # w(x) = (w0 * J(x) * integral[dx/J(x)]) / l
 
     directory = pathlib.Path(__file__).parent.absolute()
-    cd = outputs.CurrentDensity(directory / (name + ".csv"))  # creates an object with the current desnity file
-    jd = cd.current_density()  # Outputs current density
-    mean_jd = np.mean(jd, axis=0)  # finds the mean along the width of inductor
-    integral = np.trapz(1/mean_jd)
-    w0 = 2 / cd.dy #um
-    l = 800 / cd.dx #um
+    # only the inductor region (rows, columns) of the grid is kept in memory
+    # (the parsed grid is cached in a binary file next to the csv)
+    load = load_current_density_cached if cache else load_current_density
+    jd, dx, dy = load(directory / (name + ".csv"), rows=rows, columns=columns)
+    return uniformity_widths(jd[np.newaxis], dx, dy)[0]
+
+
+@functools.lru_cache(maxsize=256)
+def _uniformity(name, mtime_ns, rows, columns):
+    w = compute_uniformity_single(name, rows=rows, columns=columns)
+    w.flags.writeable = False  # the same array is handed to every caller
+    return w
+
+
+def uniformity(name, rows=None, columns=None):
+    # Memoized compute_uniformity_single. The widths are kept per csv file
+    # and its modification time, so building the inductor, resonator and
+    # geometry cells of a pixel reads the current density once and a
+    # re-exported file is read again. The returned array is read-only. Hits
+    # and misses are counted by uniformity.cache_info().
+    directory = pathlib.Path(__file__).parent.absolute()
+    mtime_ns = (directory / (name + ".csv")).stat().st_mtime_ns
+    rows = tuple(rows) if rows is not None else None
+    columns = tuple(columns) if columns is not None else None
+    return _uniformity(name, mtime_ns, rows, columns)
+
+
+uniformity.cache_info = _uniformity.cache_info
+uniformity.cache_clear = _uniformity.cache_clear
+
+
+def uniformity_widths(grids, dx, dy):
+    # The new width profiles of many current density grids at once (see
+    # compute_uniformity_single for the derivation). 'grids' is a 3-D array
+    # (pixel, y, x) or a list of 2-D grids of the same shape, e.g. memory
+    # mapped ones; a list is reduced one grid at a time so it is never copied
+    # into memory as a whole. 'dx' and 'dy' are scalars or one per grid.
+    # Returns a 2-D table of widths (pixel, x).
+    if isinstance(grids, np.ndarray) and grids.ndim == 3:
+        mean_jd = np.mean(grids, axis=1, dtype=np.float64)  # mean along the width of each inductor
+    else:
+        mean_jd = np.stack([np.mean(jd, axis=0, dtype=np.float64) for jd in grids])
+    dx = np.asarray(dx, dtype=float).reshape(-1, 1)
+    dy = np.asarray(dy, dtype=float).reshape(-1, 1)
+    integral = np.trapz(1 / mean_jd, axis=1)[:, np.newaxis]
+    w0 = 2 / dy #um
+    l = 800 / dx #um
     w = (w0 * mean_jd * integral) / l # new width
-    w_new = w * cd.dy
-    w_new = np.round_(w_new,2)
-    return w_new
-
-
-# def compute_uniformity_array(name, folder='uniformity'):
-#     directory = pathlib.Path(__file__).parent.absolute()
-#     folder = pathlib.Path(folder)
-#
-#     # load npz file
-#     npz = np.load('results.npz')
-#
-#     cd = outputs.CurrentDensity(directory / folder / (name + ".csv")) # creates an object with the current desnity file
-#
-#     # Set the boundry of the inductor region to be tapered
-#     top = int(53 / cd.dy)  # Manually setting inductor location (could change)
-#     bottom = int(55 / cd.dy)
-#     left = int(500 / cd.dx)
-#     right = int(1300 / cd.dx)
-#     jd = cd.current_density()[top:bottom,left:right] # Outputs current density
-#     mean_jd = np.mean(jd,axis=0) # finds the mean along the width of inductor
-#
-#     # the width w(x) is proportional to J(x)
-#     # we want to solve for a constant 'a' that equates w(x) = a J(x)
-#     # Inductance per square is L = Ls * l/w.
-#     # inital inductance per square is L0 = Ls * l/w0
-#     # Therefore the total inductance can be written as dL = Ls * dl/w(x)
-#     # the new inductance divided by the original L is equal to 1
-#     # L0/L = 1 = (l/w0) / (integral[dl/w(x)])
-#     # 1 = (l*a) / (w0 * integral[dl/J(x)])
-#     # a = (w0 * integral[dl/J(x)]) / l
-#     # w(x) = (w0 * J(x) * integral[dx/J(x)]) / l
-#
-#     integral = np.trapz(1/mean_jd)
-#     w0 = 2 / cd.dy #um
-#     l = 800 / cd.dx #um
-#     w = (w0 * mean_jd * integral) / l # new width
-#     print(w)
-#     return w
-
-
-# compute_uniformity_single('pixel_6d56912_11841d9')
+    return np.round_(w * dy, 2)
+
+
+def compute_uniformity_array(names, rows=None, columns=None):
+    # Width table of many exported current densities (one row per name in
+    # 'names'). The grids are loaded memory mapped from the binary cache and
+    # solved in one pass with uniformity_widths, so they must share the
+    # inductor region (rows, columns).
+    directory = pathlib.Path(__file__).parent.absolute()
+    grids, dx, dy = [], [], []
+    for name in names:
+        jd, step_x, step_y = load_current_density_cached(directory / (name + ".csv"), rows=rows, columns=columns)
+        grids.append(jd)
+        dx.append(step_x)
+        dy.append(step_y)
+    shapes = {jd.shape for jd in grids}
+    if len(shapes) > 1:
+        raise ValueError(f"Current density grids have different shapes: {sorted(shapes)}")
+    return uniformity_widths(grids, dx, dy)
@@ -1,7 +1,14 @@
+import time
+import logging
+import pathlib
+from concurrent.futures import ProcessPoolExecutor
 import gdstk
+from layout import CapacitorLayout, cached_cell, taper
 import numpy as np
 import warnings
-from current import compute_uniformity_single
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
 
 
 def feedline(**kwargs):
@@ -51,6 +58,7 @@ def feedline(**kwargs):
     return cell
 
 
+@cached_cell
 def capacitor(**kwargs):
 
     cell = gdstk.Cell(kwargs.get("name", "capacitor"))
@@ -69,7 +77,6 @@ def capacitor(**kwargs):
 
     # Capacitor parameters
     finger_pairs = 6
-    fingers = 2 * finger_pairs
     finger_gap = kwargs.get("finger_gap", 3)
     finger_width = kwargs.get("finger_width", 2)
     coupling_bar_gap = kwargs.get("coupling_bar_gap", 0.5)
@@ -80,57 +87,22 @@ def capacitor(**kwargs):
     bar_width = kwargs.get("bar_width", 325)  # this is the length of the bottom bar
     coupling_bar_height_max = cavity_height - 3 * coupling_bar_gap  # sets the height of the coupling bar within the cavity in the feedline
     coupling_bar_height = kwargs.get('coupling_bar_height',46)
-    right_bar_width = bar_width - left_bar_width - bar_gap
 
     #### capacitor geometry ####
+    layout = CapacitorLayout(ground1_width, gap, center_width, ground2_width, bottom_ground_height,
+                             coupling_bar_gap, coupling_bar_width, coupling_bar_height_max, left_bar_width,
+                             bar_gap, bar_height, bar_width, finger_gap, finger_width, finger_pairs)
+
     # this is the coupling bar at the origin
-    coupling_bar = gdstk.rectangle((ground1_width + gap + center_width + gap + ground2_width + coupling_bar_gap,
-                                    bottom_ground_height + coupling_bar_gap + coupling_bar_height_max),
-                                   (
-                                       ground1_width + gap + center_width + gap + ground2_width + coupling_bar_gap + coupling_bar_width,
-                                       bottom_ground_height + coupling_bar_gap + coupling_bar_height))
-    cell.add(coupling_bar)
-
-    # this is the left bar that forms the partial boundry of the interdigited capacitor
-    path = gdstk.FlexPath(
-        (ground1_width + gap + center_width + gap + ground2_width + coupling_bar_gap + coupling_bar_width,
-         bottom_ground_height + coupling_bar_gap + coupling_bar_height_max / 2 - bar_height / 2), bar_height)
-    path = path.horizontal(
-        ground1_width + gap + center_width + gap + ground2_width + coupling_bar_gap + coupling_bar_width + left_bar_width,
-        bar_height)
-    cell.add(path)
+    cell.add(layout.coupling_bar(coupling_bar_height))
 
-    # right capacitor bar
-    path = gdstk.FlexPath((
-        ground1_width + gap + center_width + gap + ground2_width + coupling_bar_gap + coupling_bar_width + left_bar_width + bar_gap,
-        bottom_ground_height + coupling_bar_gap + coupling_bar_height_max / 2 - bar_height / 2),
-        bar_height)
-    path = path.horizontal(
-        ground1_width + gap + center_width + gap + ground2_width + coupling_bar_gap + coupling_bar_width + left_bar_width + bar_gap + right_bar_width + bar_height / 2,
-        bar_height)
-    path = path.vertical(
-        bottom_ground_height + coupling_bar_gap + coupling_bar_height_max / 2 + fingers * (finger_gap + finger_width))
-    cell.add(path)
+    # these are the left and right bars that form the boundry of the interdigited capacitor
+    cell.add(*layout.bars())
 
     # these rectangles are used to transition into the inductor
-    patch1 = gdstk.rectangle((
-        ground1_width + gap + center_width + gap + ground2_width + coupling_bar_gap + coupling_bar_width + left_bar_width,
-        bottom_ground_height + coupling_bar_gap + coupling_bar_height_max / 2 - bar_height),
-        (
-            ground1_width + gap + center_width + gap + ground2_width + coupling_bar_gap + coupling_bar_width + left_bar_width - bar_height,
-            bottom_ground_height + coupling_bar_gap + coupling_bar_height_max / 2 - bar_height - spacing_between_inductor_waveguide - inductor_width))
-
-    patch2 = gdstk.rectangle((
-        ground1_width + gap + center_width + gap + ground2_width + coupling_bar_gap + coupling_bar_width + left_bar_width + bar_gap,
-        bottom_ground_height + coupling_bar_gap + coupling_bar_height_max / 2 - bar_height),
-        (
-            ground1_width + gap + center_width + gap + ground2_width + coupling_bar_gap + coupling_bar_width + left_bar_width + bar_gap + bar_height,
-            bottom_ground_height + coupling_bar_gap + coupling_bar_height_max / 2 - bar_height - spacing_between_inductor_waveguide - inductor_width))
-    cell.add(patch1)
-    cell.add(patch2)
+    cell.add(*layout.patches(spacing_between_inductor_waveguide, inductor_width))
 
     # Define capacitor fingers
-    total_fill = 0
     fill = kwargs.get("fill", 1950) # sets the fill we want the sum of our fingers to have
     shrink = kwargs.get("shrink", None)  # overrides fill
     base_fill = (bar_width/2 + finger_gap) # minimum fill we want our individual finger
@@ -155,27 +127,8 @@ def capacitor(**kwargs):
             message = "The 'fill' parameter should be positive."
         warnings.warn(message, RuntimeWarning)
 
-    direction = -1
-    position = bottom_ground_height + coupling_bar_gap + coupling_bar_height_max/2 + finger_gap
-    finger_space = finger_width
-    fingerss = []
-    for _ in range(finger_pairs):
-        added_fill = min(max_fill, fill - total_fill)
-        if added_fill < base_fill:
-            added_fill = base_fill
-        total_fill += added_fill
-        for i in range(2):
-            direction *= -1
-            start = ground1_width + gap + center_width + gap + ground2_width + coupling_bar_gap + coupling_bar_width \
-                if i % 2 == 0 else ground1_width + gap + center_width + gap + ground2_width + coupling_bar_gap + coupling_bar_width + bar_width
-            stop = start + direction * added_fill if i % 2 == 0 \
-                else ground1_width + gap + center_width + gap + ground2_width + coupling_bar_gap + coupling_bar_width + bar_width + direction * added_fill
-            fingerss.append(gdstk.rectangle(
-                (start, position), (stop - finger_space, position + finger_width)))
-            position += (finger_gap + finger_width)
-            finger_space *= -1
-
-    cell.add(*fingerss)
+    added_fill = layout.added_fill(fill, base_fill, max_fill)
+    cell.add(*layout.finger_polygons(added_fill))
 
     return cell
 
@@ -215,18 +168,22 @@ def inductor(**kwargs):
 
     cell.add(overlapped_inductor)
 
-    w = compute_uniformity_single(name)
+    # widths from the current density exported for this pixel (memoized, the
+    # resonator and geometry cells of a pixel share the result) unless they
+    # were solved for the whole array at once
+    w = kwargs.get("widths")
+    if w is None:
+        from current import uniformity
+        w = uniformity(kwargs.get("current_name", "current1"))
 
     start_x = ground1_width + gap + center_width + gap + ground2_width + coupling_bar_gap + coupling_bar_width + left_bar_width
     start_y = bottom_ground_height + coupling_bar_gap + coupling_bar_height / 2 - bar_height - 2 * spacing_between_inductor_waveguide - 2 * inductor_width
-    inductor_piece = []
 
-    for width in w:
-        inductor_piece.append(gdstk.rectangle(
-            (start_x,start_y),(start_x + dx, start_y + width)))
-        start_x = start_x + dx
+    # the taper is one polygon instead of a rectangle per grid step
+    tolerance = kwargs.get("taper_tolerance", 0)  # widths closer than this are merged into one step
+    cell.add(gdstk.Polygon(taper(start_x, start_y, w, dx, tolerance)))
+    start_x = start_x + len(w) * dx
 
-    cell.add(*inductor_piece)
     path = gdstk.FlexPath((start_x - 2 * dx,start_y),inductor_width)
     path = path.vertical(bottom_ground_height + coupling_bar_gap + coupling_bar_height / 2 - bar_height - spacing_between_inductor_waveguide - inductor_width / 2,inductor_width)
     path = path.horizontal(ground1_width + gap + center_width + gap + ground2_width + coupling_bar_gap + coupling_bar_width + left_bar_width + bar_gap,inductor_width)
@@ -235,38 +192,134 @@ def inductor(**kwargs):
     return cell
 
 def resonator(**kwargs):
-    cell = gdstk.Cell(kwargs.get("name", "resonator"))
-    induct = inductor(**kwargs)
-    capac = capacitor(**kwargs)
+    name = kwargs.get("name", "resonator")
+    cell = gdstk.Cell(name)
+    induct = inductor(**dict(kwargs, name=f"{name}_inductor"))
+    capac = capacitor(**dict(kwargs, name=f"{name}_capacitor"))
     cell.add(gdstk.Reference(induct))
     cell.add(gdstk.Reference(capac))
-    cell.flatten()
+    if kwargs.get("flatten", True):
+        cell.flatten()
     return cell
 
 def geometry(**kwargs):
-    cell = gdstk.Cell(kwargs.get('name', 'geometry'))
-    induct = inductor(**kwargs)
-    capac = capacitor(**kwargs)
-    fl = feedline(**kwargs)
+    name = kwargs.get('name', 'geometry')
+    cell = gdstk.Cell(name)
+    induct = inductor(**dict(kwargs, name=f"{name}_inductor"))
+    capac = capacitor(**dict(kwargs, name=f"{name}_capacitor"))
+    fl = feedline(**dict(kwargs, name=f"{name}_feedline"))
     cell.add(gdstk.Reference(induct))
     cell.add(gdstk.Reference(capac))
     cell.add(gdstk.Reference(fl))
-    cell.flatten()
+    if kwargs.get("flatten", True):
+        cell.flatten()
     return cell
 
-if __name__ == '__main__':
+def array(pixels, **kwargs):
+    # Hierarchical layout of the whole array. 'pixels' is a list of
+    # (name, kwargs) for each resonator. The feedline is defined once and
+    # repeated along y, each pixel references its own inductor and a capacitor
+    # cell that is shared by all pixels with the same fill and coupling.
     library = gdstk.Library()
-    cap = dict(coupling_bar_height= 0, fill= 0)
-    # load npz data
-    npz = np.load('/home/mohammadm/Majid/Python/SpecRes/sonnet/fine/results.npz')
-    npz = npz['arr_0']
-    for fc, qc, c_fill, c_length in npz:
+    top = gdstk.Cell(kwargs.pop('name', 'array'))
+    pitch = kwargs.pop('pitch', None)  # distance between pixels (defaults to the feedline height)
+
+    fl = feedline(**kwargs)
+    library.add(fl)
+    (_, y0), (_, y1) = fl.bounding_box()
+    if pitch is None:
+        pitch = y1 - y0
+    top.add(gdstk.Reference(fl, (0, 0), columns=1, rows=len(pixels), spacing=(0, pitch)))
+
+    # The inductor widths of the pixels without explicit widths are solved
+    # together. If their grids differ in shape, each pixel is solved on its own.
+    from current import compute_uniformity_array, uniformity
+    widths = {}  # index -> widths
+    solve = {}  # index -> current_name of the pixels to solve
+    for index, (name, pixel_kwargs) in enumerate(pixels):
+        params = dict(kwargs, **pixel_kwargs)
+        if params.get('widths') is not None:
+            widths[index] = params['widths']
+        else:
+            solve[index] = params.get('current_name', name)
+    if solve:
+        try:
+            widths.update(zip(solve, compute_uniformity_array(list(solve.values()))))
+        except ValueError as error:
+            log.warning(f"{error}, solving the inductor widths pixel by pixel")
+            widths.update((index, uniformity(current_name)) for index, current_name in solve.items())
+
+    added = set()
+    for index, (name, pixel_kwargs) in enumerate(pixels):
+        params = dict(kwargs, **pixel_kwargs)
+        current_name = params.pop('current_name', name)
+        params.pop('widths', None)
+        cap_name = f"capacitor_{params.get('fill', 1950):g}_{params.get('coupling_bar_height', 46):g}"
+        capac = capacitor(**dict(params, name=cap_name.replace('.', 'd')))
+        induct = inductor(**dict(params, name=f"{name}_inductor", current_name=current_name,
+                                 widths=widths[index]))
+        res = gdstk.Cell(f"{name}_resonator")
+        res.add(gdstk.Reference(induct), gdstk.Reference(capac))
+        for cell in (capac, induct, res):
+            if cell.name not in added:
+                library.add(cell)
+                added.add(cell.name)
+        top.add(gdstk.Reference(res, (0, index * pitch)))
+
+    library.add(top)
+    return library
+
+def load_pixels(results_file):
+    # (name, kwargs) for every pixel saved by fine_grid.py
+    npz = np.load(results_file)
+    pixels = []
+    for fc, qc, c_fill, c_length in npz['arr_0']:
         name = f"pixel_{fc:g}_{qc:g}".replace('.', 'd')
-        cap['coupling_bar_height'] = c_length
-        cap['fill'] = c_fill
-        library.add(feedline())
-        library.add(capacitor(**cap))
-        library.add(inductor())
-        library.add(resonator(**cap))
-        library.add(geometry(**cap))
-        library.write_gds('/home/mohammadm/Majid/Python/SpecRes/sonnet/final/' + name + '.gds')
+        pixels.append((name, dict(coupling_bar_height=c_length, fill=c_fill, current_name=name)))
+    return pixels
+
+def write_pixel(file_name, name, kwargs):
+    # write a single pixel (feedline and resonator) to its own file
+    cell = geometry(**dict(kwargs, name=name, flatten=False))
+    library = gdstk.Library()
+    library.add(cell, *cell.dependencies(True))
+    library.write_gds(file_name)
+    return file_name
+
+def export_array(results_file, file_name, pixel_folder=None, workers=None, **kwargs):
+    # Build the whole array from the fine_grid.py results and write it once.
+    # If 'pixel_folder' is given, each pixel is also written to its own file
+    # using 'workers' processes. Returns the time spent in each stage.
+    timing = {}
+    start = time.perf_counter()
+    pixels = load_pixels(results_file)
+    timing['load'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    library = array(pixels, **kwargs)
+    timing['build'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    library.write_gds(file_name)
+    timing['write'] = time.perf_counter() - start
+
+    if pixel_folder is not None:
+        start = time.perf_counter()
+        pixel_folder = pathlib.Path(pixel_folder)
+        pixel_folder.mkdir(parents=True, exist_ok=True)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(write_pixel, pixel_folder / f"{name}.gds", name, dict(kwargs, **pixel_kwargs))
+                       for name, pixel_kwargs in pixels]
+            for future in futures:
+                future.result()
+        timing['pixels'] = time.perf_counter() - start
+
+    for stage, seconds in timing.items():
+        log.info(f"{stage}: {seconds:.3f} s")
+    return timing
+
+if __name__ == '__main__':
+    logging.basicConfig(level='INFO')
+    export_array('/home/mohammadm/Majid/Python/SpecRes/sonnet/fine/results.npz',
+                 '/home/mohammadm/Majid/Python/SpecRes/sonnet/final/array.gds',
+                 pixel_folder='/home/mohammadm/Majid/Python/SpecRes/sonnet/final/')
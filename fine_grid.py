@@ -1,11 +1,12 @@
 import pathlib
 import logging
+from concurrent.futures import ProcessPoolExecutor, wait
 import numpy as np
 from fitting import find_resonance, fit
-from current import export_current_density
-from simulation import single_pixel
-
-logging.basicConfig(level=logging.INFO)
+from scheduler import sweep_row, search_row, prepare_export, accepted_pixel, run_row, sweep_parameters
+from surrogate import Surrogate
+from journal import Journal
+from current import export_current_density_batch
 
 max_fill = 1950
 d_fill = 0.5  # smallest capacitor fill that keeps to the sonnet grid
@@ -13,52 +14,156 @@ max_length = 46 # this is the smallest coupling. coupling bar decreases with hig
 d_length = 0.5  # smallest coupling length that keeps to the sonnet grid
 qc_target = 20000
 tolerance = 10000
+workers = 4  # number of simulations run at once (should not exceed the available sonnet licences)
+fit_workers = 2  # number of fits run alongside the simulations
+export_workers = 1  # number of accepted pixels prepared for export (and soncmd exports run at once)
+export_source = 'sweep'  # 'sweep' exports the current density from the solved sweep, 'single' simulates again at f0
+# The tapered widths only depend on the shape of the inductor current, not
+# its amplitude (uniformity_widths is scale invariant in J). The inductor is
+# much shorter than a wavelength, so that shape changes on the scale of f0
+# itself rather than the linewidth, and a solved sweep frequency within this
+# fraction of f0 is used as is.
+shape_tolerance = 1e-3
+# Solve with the em command line tool, whose output gives the frequencies a
+# sweep solved (needed by export_source = 'sweep'). The parsing of that
+# output has not been checked against a real em log yet, so this is off and
+# the exports are simulated again at f0 until it is.
+em_runner = False
+parallel_rows = False  # search whole fill rows in parallel, each in its own subfolder with its own journal and log
+licences = 4  # sonnet licences used at once by the parallel rows (one row per licence)
+resume = True  # continue from the journal of a previous (interrupted) sweep
+search = 'surrogate'  # 'surrogate' and 'secant' search the coupling lengths of a row, 'linear' scans them in order
 directory = pathlib.Path(__file__).parent.absolute()
 folder = pathlib.Path('sonnet/fine')
 
 cap_low_freq = dict(fill=1950, coupling_bar_height=0)
 cap_high_freq = dict(fill=0, coupling_bar_height=46)
-cap = dict(coupling_bar_height=0, fill=0)
-# find resonance of two most extreme capacitor fills
-find_resonance("low_freq", folder=folder, epsilon=9.3, capacitor_kwargs=cap_low_freq, f1=4, f2=8)
-find_resonance("high_freq", folder=folder, epsilon=9.3, capacitor_kwargs=cap_high_freq, f1=4, f2=8)
-
-# fit the two extreme pixels
-f0 = fit("pixel_low", folder=folder)["f0"]
-f1 = fit("pixel_high", folder=folder)["f0"]
-
-# make and array of capacitor fill values
-f = np.linspace(f0, f1, 10)
-fill_array = (f0 / f)**2 * (f1**2 - f**2) / (f1**2 - f0**2) * max_fill
-fill_array = np.round(fill_array[::-1] / d_fill) * d_fill
-
-# Make an array of coupler length values
-length_array = np.arange(0,max_length,d_length)
-save_array = [] # array of f, qc, fill, coupling
-
-f2 = 8
-for fill in fill_array: # go down the list of fill sizes
-    f1 = 4
-    for length in length_array:
-        name = f"pixel_{abs(fill):g}_{length:g}".replace('.', 'd')
-        cap['coupling_bar_height']=length
-        cap['fill']=fill
-        find_resonance(name, epsilon=9.3, folder=folder, capacitor_kwargs=cap, f1=f1, f2=f2,)
-        result = fit(name, folder=folder)
-
-        if result['qc'] < qc_target - tolerance:
-            break
-        elif abs(result['qc'] - qc_target) < tolerance:
-            save_array.append([result['f0'], result['qc'], fill, length])
-            filename = f"pixel_{result['f0']:g}_{result['qc']:g}".replace('.', 'd')
-            single_pixel(filename, single_freq=True, folder=folder, epsilon=9.3, capacitor_kwargs=cap, f1=round(result['f0'],4))
-            export_current_density(folder= folder, xml_name=name, csv_name=f"{filename}.csv",
-                                   son_label=f"{filename}.son", frequency=str(int(round(result['f0'],4)*10**9)))
-            break
-        else:
-            continue
-
-# Save the data
-save_array = np.array(save_array)
-np.savez(directory / folder / "results.npz", save_array)
 
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    # find resonance of two most extreme capacitor fills
+    find_resonance("low_freq", folder=folder, epsilon=9.3, capacitor_kwargs=cap_low_freq, f1=4, f2=8)
+    find_resonance("high_freq", folder=folder, epsilon=9.3, capacitor_kwargs=cap_high_freq, f1=4, f2=8)
+
+    # fit the two extreme pixels
+    low = fit("low_freq", folder=folder)
+    high = fit("high_freq", folder=folder)
+    f0 = low["f0"]
+    f1 = high["f0"]
+
+    # seed the surrogate model with the extreme pixels
+    surrogate = Surrogate() if search == 'surrogate' else None
+    if surrogate is not None:
+        surrogate.add(cap_low_freq['fill'], cap_low_freq['coupling_bar_height'], low['f0'], low['qc'])
+        surrogate.add(cap_high_freq['fill'], cap_high_freq['coupling_bar_height'], high['f0'], high['qc'])
+
+    # make and array of capacitor fill values
+    f = np.linspace(f0, f1, 10)
+    fill_array = (f0 / f)**2 * (f1**2 - f**2) / (f1**2 - f0**2) * max_fill
+    fill_array = np.round(fill_array[::-1] / d_fill) * d_fill
+
+    # Make an array of coupler length values
+    length_array = np.arange(0,max_length,d_length)
+    save_array = [] # array of f, qc, fill, coupling
+    simulations = [] # number of simulations spent on each fill (journaled results are not counted)
+    rows = {} # accepted pixel (or None) of each fill
+    f2 = 8
+
+    if parallel_rows:
+        # The rows are independent, so each one is searched by its own worker
+        # process. The surrogate is not shared between the workers, so the
+        # rows use the secant search (or the linear scan).
+        with ProcessPoolExecutor(max_workers=licences) as executor:
+            futures = [executor.submit(run_row, fill, length_array, qc_target, tolerance, folder,
+                                       search=search, resume=resume, export_source=export_source,
+                                       shape_tolerance=shape_tolerance, epsilon=9.3, f1=4, f2=f2,
+                                       em_runner=em_runner)
+                       for fill in fill_array]
+            for future in futures:
+                fill, accepted, count = future.result()
+                rows[fill] = accepted
+                simulations.append((fill, count))
+    else:
+        exports = [] # current density exports of the accepted pixels
+
+        # every evaluation and accepted pixel is journaled as soon as it is known
+        parameters = sweep_parameters(qc_target, tolerance, length_array, search, epsilon=9.3, f1=4, f2=f2)
+        journal = Journal(directory / folder / "journal.jsonl", resume=resume, parameters=parameters)
+        if surrogate is not None:
+            for (fill, length), result in journal.evaluations.items():
+                surrogate.add(fill, length, result['f0'], result['qc'])
+
+        # the simulation pool is shut down first (the pools close in reverse
+        # order) so simulations still running can hand their fits over
+        with ProcessPoolExecutor(max_workers=fit_workers) as fit_executor, \
+                ProcessPoolExecutor(max_workers=export_workers) as export_executor, \
+                ProcessPoolExecutor(max_workers=workers) as executor:
+
+            def export(accepted, fill):
+                # solve the project to export from off the critical path
+                cap = dict(coupling_bar_height=accepted['length'], fill=fill)
+                sweep = accepted.get('sweep') if export_source == 'sweep' else None
+                future = export_executor.submit(prepare_export, accepted['name'], folder, cap, accepted['f0'],
+                                                sweep=sweep, bandwidth=shape_tolerance * accepted['f0'],
+                                                epsilon=9.3, em_runner=em_runner)
+                exports.append((accepted['name'], future))
+
+            for fill in fill_array: # go down the list of fill sizes
+                f1 = 4
+                if journal.row_done(fill):
+                    accepted = journal.row(fill)
+                    logging.info(f"fill {fill:g}: already done")
+                    if accepted is not None and accepted['name'] not in journal.exports:
+                        export(accepted, fill)
+                    continue
+                if search == 'linear':
+                    accepted, _, count = sweep_row(executor, fill, length_array, qc_target, tolerance, folder,
+                                                   workers=workers, fit_executor=fit_executor, journal=journal,
+                                                   epsilon=9.3, f1=f1, f2=f2, em_runner=em_runner)
+                else:
+                    accepted, _, count = search_row(executor, fill, length_array, qc_target, tolerance, folder,
+                                                    surrogate=surrogate, fit_executor=fit_executor,
+                                                    journal=journal, epsilon=9.3, f1=f1, f2=f2,
+                                                    em_runner=em_runner)
+                simulations.append((fill, count))
+                if accepted is None:
+                    journal.record_row(fill)
+                    continue
+                accepted = accepted_pixel(fill, *accepted)
+                journal.record_row(fill, accepted)
+                export(accepted, fill)
+
+            # Export the current densities of the prepared pixels in one batch.
+            # A failed export doesn't stop the results from being saved (it is
+            # retried when the sweep is resumed).
+            wait([future for _, future in exports])
+            pending = []
+            for name, future in exports:
+                if future.exception() is not None:
+                    logging.error(f"{name}: export failed: {future.exception()!r}")
+                else:
+                    pending.append((name, future.result()))
+            errors = export_current_density_batch([export for _, export in pending], workers=export_workers)
+            for (name, _), error in zip(pending, errors):
+                if error is None:
+                    journal.record_export(name)
+                else:
+                    logging.error(f"{name}: export failed: {error!r}")
+
+        # the accepted pixels of every row, including resumed ones
+        rows = {fill: journal.row(fill) for fill in fill_array}
+
+    # collect the accepted pixels
+    for fill in fill_array:
+        accepted = rows[fill]
+        if accepted is not None:
+            save_array.append([accepted['f0'], accepted['qc'], fill, accepted['length']])
+
+    for fill, count in simulations:
+        logging.info(f"fill {fill:g}: {count} simulations")
+    logging.info(f"{sum(count for _, count in simulations)} simulations in total")
+
+    # Save the data
+    save_array = np.array(save_array)
+    np.savez(directory / folder / "results.npz", save_array)
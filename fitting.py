@@ -1,50 +1,157 @@
+import os
 import pathlib
 import numpy as np
 import loopfit as lf
-from simulation import single_pixel
-import gdstk
+from cache import SimulationCache, read_key
 import logging
 
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
 directory = pathlib.Path(__file__).parent.absolute()
 
-def find_resonance(name, folder ='sonnet/testing', **kwargs):
+def find_resonance(name, folder ='sonnet/testing', cache=True, f0_guess=None, span=0.1, **kwargs):
+
+    from simulation import single_pixel  # delay pysonnet and gdstk imports
+
+    # The simulation cache is keyed on the pixel geometry and solver settings.
+    # With cache=False an existing file with the same name is reused instead.
+    if cache is True:
+        cache = SimulationCache()
+    if cache:
+        kwargs['cache'] = cache
+
+    # Simulate a narrow window around the predicted resonance (if given)
+    # within the full f1 to f2 band.
+    f_min = kwargs.setdefault('f1', 4)
+    f_max = kwargs.setdefault('f2', 8)
+    if f0_guess is not None:
+        f0_guess = min(max(f0_guess, f_min), f_max)  # an extrapolated guess may fall outside of the band
+        kwargs['f1'] = max(f_min, round(f0_guess / 0.01) * 0.01 - span)
+        kwargs['f2'] = min(f_max, round(f0_guess / 0.01) * 0.01 + span)
 
-    # Create single pixel if file does not exist
+    # Create single pixel if file does not exist (or is not cached)
     file = directory / pathlib.Path(folder) / (name + ".ts")
-    if not file.is_file():
+    if cache or not file.is_file():
         single_pixel(name=name,folder=folder, **kwargs)
 
 
     # Load in the data to run the simulation
     f, i, q = lf.load_touchstone(file)
-    mag = 10 * np.log10(i**2 + q**2)
+    resonance = locate_resonance(f, i, q)
+
+    # Widen the window around the band edge while the dip lands on it
+    while resonance['edge'] and (kwargs['f1'] > f_min or kwargs['f2'] < f_max):
+        span *= 4
+        kwargs['f1'] = max(f_min, round(resonance['f0'] / 0.01) * 0.01 - span)
+        kwargs['f2'] = min(f_max, round(resonance['f0'] / 0.01) * 0.01 + span)
+        kwargs['overwrite'] = True
+        log.info(f"'{name}' resonance is outside of the window, trying {kwargs['f1']:g} - {kwargs['f2']:g} GHz")
+        single_pixel(name=name,folder=folder, **kwargs)
+        f, i, q = lf.load_touchstone(file)
+        resonance = locate_resonance(f, i, q)
 
-    # Re-simulate if Sonnet didn't converge
-    index = np.argmin(mag)
-    if mag[index] > -10 and index not in [0, mag.size - 1]:
-        kwargs['f1'] = round(f[index] / 0.01) * 0.01 - 0.1
-        kwargs['f2'] = round(f[index] / 0.01) * 0.01 + 0.1
+    # Re-simulate around the dip if Sonnet didn't converge
+    if not resonance['converged'] and not resonance['edge']:
+        f1, f2 = resonance['window']
+        kwargs['f1'], kwargs['f2'] = max(f_min, f1), min(f_max, f2)
         kwargs['overwrite'] = True
         single_pixel(name=name,folder=folder, **kwargs)
 
         # Load in the data.
         f, i, q = lf.load_touchstone(file)
-        mag = 10 * np.log10(i**2 + q**2)
+        resonance = locate_resonance(f, i, q)
 
         # Raise an error if the simulation still does not look good.
-        index = np.argmin(mag)
-        if mag[index] > -10 and index not in [0, mag.size - 1]:
+        if not resonance['converged'] and not resonance['edge']:
             raise RuntimeError(f"'{name}' did not converge.")
 
+    # the data is returned so that it can be fitted without loading it again
+    resonance['data'] = f, i, q
+    return resonance
 
-def fit(name, folder="sonnet/testing", plot=False):
-    file = directory / pathlib.Path(folder) / (name + ".ts")
-    f, i, q = lf.load_touchstone(file)
-    mag = 10 * np.log10(i ** 2 + q ** 2)
-    index = np.argmin(mag)
-    mask = (f > f[index] - 0.1) & (f < f[index] + 0.1)
+
+def locate_resonance(f, i, q, threshold=-10, max_span=0.1):
+    # Find the resonance dip in |S21| with sub-sample resolution. Returns a
+    # dictionary with:
+    #   index: sample closest to the dip
+    #   f0: dip frequency from a parabola through the three samples around it
+    #   depth: dip depth in dB from the same parabola
+    #   linewidth: full width at half depth of |S21|**2 (nan if not resolved)
+    #   edge: True if the dip is on the first or last sample
+    #   converged: True if the dip is deeper than 'threshold' dB
+    #   window: suggested (f1, f2) to re-simulate, on a 0.01 GHz grid, at most
+    #           'max_span' GHz to either side of f0
+    power = i**2 + q**2
+    mag = 10 * np.log10(power)
+    index = int(np.argmin(mag))
+    edge = index in [0, mag.size - 1]
+    f0, depth = f[index], mag[index]
+    if not edge:
+        x = f[index - 1:index + 2] - f[index]
+        a, b, c = np.polyfit(x, mag[index - 1:index + 2], 2)
+        if a > 0:
+            vertex = np.clip(-b / (2 * a), x[0], x[2])
+            f0 = f[index] + vertex
+            depth = min(c - b**2 / (4 * a), mag[index])
+
+    # full width at half depth relative to the median (off resonance) level
+    half = (np.median(power) + power[index]) / 2
+    above = power > half
+    left = np.flatnonzero(above[:index])
+    right = np.flatnonzero(above[index:])
+    linewidth = np.nan
+    if left.size and right.size:
+        l0 = left[-1]
+        r0 = index + right[0]
+        f_left = np.interp(half, [power[l0 + 1], power[l0]], [f[l0 + 1], f[l0]])
+        f_right = np.interp(half, [power[r0 - 1], power[r0]], [f[r0 - 1], f[r0]])
+        linewidth = f_right - f_left
+
+    half_span = max_span
+    if np.isfinite(linewidth):
+        half_span = min(max(5 * linewidth, 0.01), max_span)
+    window = (np.floor((f0 - half_span) / 0.01) * 0.01, np.ceil((f0 + half_span) / 0.01) * 0.01)
+    return dict(index=index, f0=float(f0), depth=float(depth), linewidth=float(linewidth), edge=edge,
+                converged=bool(depth <= threshold), window=window)
+
+
+def _fit_data(f, i, q, prior=None):
+    # Fit the data within 0.1 GHz of the dip. If a prior fit result (e.g. of
+    # the neighboring pixel) is given, its parameters are used as the initial
+    # guess and lf.guess is only relied on if that fit does not converge.
+    f0 = locate_resonance(f, i, q)['f0']
+    mask = (f > f0 - 0.1) & (f < f0 + 0.1)
     guess = lf.guess(f[mask], i[mask], q[mask], phase0=0, phase1=0)
+    if prior is not None:
+        warm = dict(guess, **{key: prior[key] for key in guess if key in prior})
+        try:
+            result = lf.fit(f[mask], i[mask], q[mask], **warm)
+        except Exception as error:
+            log.debug(f"warm started fit failed: {error}")
+        else:
+            if result.get('success', True):
+                return result, mask
+            log.debug("warm started fit did not converge, using lf.guess")
     result = lf.fit(f[mask], i[mask], q[mask], **guess)
+    return result, mask
+
+
+def fit(name, folder="sonnet/testing", plot=False, cache=True, prior=None, data=None):
+    file = directory / pathlib.Path(folder) / (name + ".ts")
+
+    # reuse the fit of a cached simulation
+    if cache is True:
+        cache = SimulationCache()
+    key = read_key(file) if cache else None
+    if key is not None and not plot:
+        result = cache.load_fit(key)
+        if result is not None:
+            return result
+
+    # 'data' is the (f, i, q) already loaded by find_resonance
+    f, i, q = data if data is not None else lf.load_touchstone(file)
+    result, mask = _fit_data(f, i, q, prior=prior)
     if plot:
         from matplotlib import pyplot as plt  # delay pyplot import
         fig, axes = plt.subplots(ncols=2)
@@ -62,13 +169,53 @@ def fit(name, folder="sonnet/testing", plot=False):
         axes[1].set_ylabel("$S_{21}$ [dB]")
         fig.tight_layout()
         plt.show()
+    if key is not None:
+        cache.store_fit(key, result)
     return result
 
 
+fit_dtype = [('name', 'U128'), ('f0', float), ('qi', float), ('qc', float), ('success', bool),
+             ('depth', float), ('rms', float), ('points', int), ('error', 'U128')]
+
+
+def _fit_file(file):
+    # one row of the fit_batch table (runs inside a worker process)
+    file = pathlib.Path(file)
+    try:
+        f, i, q = lf.load_touchstone(file)
+        result, mask = _fit_data(f, i, q)
+        model = lf.model(f[mask], **result)
+        rms = np.sqrt(np.mean(np.abs(model - (i[mask] + 1j * q[mask]))**2))  # residual of the fit
+        depth = 10 * np.log10(np.min(i**2 + q**2))  # depth of the dip in dB
+        return (file.stem, result['f0'], result['qi'], result['qc'], bool(result.get('success', True)),
+                depth, rms, int(mask.sum()), "")
+    except Exception as error:  # keep going, the failure is recorded in the table
+        return (file.stem, np.nan, np.nan, np.nan, False, np.nan, np.nan, 0, str(error)[:128])
+
+
+def fit_batch(files, workers=None):
+    # Fit many touchstone files at once. 'files' is a directory (every .ts
+    # file in it is fitted) or a list of files. The files are loaded and
+    # fitted across a process pool with 'workers' processes. Returns a record
+    # array with the name, f0, qi, qc and fit diagnostics of each file: the
+    # fitter's success flag, the dip depth [dB], the rms residual of the
+    # model, the number of points fitted and the error message if it failed.
+    from concurrent.futures import ProcessPoolExecutor
+    if isinstance(files, (str, pathlib.Path)):
+        files = sorted(pathlib.Path(files).glob("*.ts"))
+    files = [pathlib.Path(file) for file in files]
+    if not files:
+        return np.rec.array(np.empty(0, dtype=fit_dtype))
+    workers = workers or os.cpu_count() or 1
+    chunksize = max(1, len(files) // (4 * workers))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        rows = list(executor.map(_fit_file, files, chunksize=chunksize))
+    return np.rec.fromrecords(rows, dtype=fit_dtype)
+
+
 if __name__ == "__main__":
 
     logging.basicConfig(level='INFO') # spits information out into the terminal
-    library = gdstk.Library()
     # feed = dict(center_width=8, gap=3, height=200, ground2_width=0.5, bottom_ground_height=24, cavity_height=115)
     # ind = dict(spacing_between_inductor_waveguide=7, inductor_width=2, inductor_overlap=7, inductor_length=900)
     cap_low = dict(coupling_bar_height=54.75)
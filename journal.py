@@ -0,0 +1,99 @@
+import os
+import json
+import logging
+import pathlib
+import threading
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+def _key(*values):
+    # float keys that survive the round trip through json
+    return tuple(round(float(value), 6) for value in values)
+
+
+class Journal:
+    # Append-only record of a fine_grid.py sweep. Every line is a json object:
+    #   {"type": "header", "parameters"}
+    #   {"type": "evaluation", "fill", "length", "f0", "qc", "qi"}
+    #   {"type": "row", "fill", "accepted": null or {"length", "f0", "qc", "qi", "name", "sweep"}}
+    #   {"type": "export", "name"}
+    # With resume=True the existing records are loaded so that completed work
+    # can be skipped, otherwise the file is started over. 'parameters' are the
+    # sweep settings (target, tolerance, length grid, ...) the results depend
+    # on; a journal written with other parameters is not resumed.
+    def __init__(self, file, resume=True, parameters=None):
+        self.file = pathlib.Path(file)
+        self.parameters = json.loads(json.dumps(parameters, default=float))  # as they are read back
+        self.evaluations = {}  # (fill, length) -> dict(f0, qc, qi)
+        self.rows = {}  # (fill,) -> accepted dict or None
+        self.exports = set()
+        self._lock = threading.Lock()  # exports are recorded from executor callbacks
+        if resume and self.file.is_file():
+            header = self._load()
+            if header != self.parameters:
+                raise ValueError(f"{self.file} was written with other sweep parameters ({header}), "
+                                 f"move it or run with resume=False to start over")
+            log.info(f"Resuming from {self.file}: {len(self.evaluations)} evaluations, "
+                     f"{len(self.rows)} rows, {len(self.exports)} exports")
+        else:
+            self.file.parent.mkdir(parents=True, exist_ok=True)
+            self.file.write_text("")
+            self._append(dict(type='header', parameters=self.parameters))
+
+    def _load(self):
+        # load the records and return the parameters of the header
+        header = None
+        with open(self.file) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:  # a line cut short by a crash
+                    continue
+                kind = record.pop('type')
+                if kind == 'header':
+                    header = record['parameters']
+                elif kind == 'evaluation':
+                    fill, length = record.pop('fill'), record.pop('length')
+                    self.evaluations[_key(fill, length)] = record
+                elif kind == 'row':
+                    self.rows[_key(record['fill'])] = record['accepted']
+                elif kind == 'export':
+                    self.exports.add(record['name'])
+        return header
+
+    def _append(self, record):
+        with self._lock, open(self.file, 'a') as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def evaluation(self, fill, length):
+        # the journaled fit result of a pixel or None
+        return self.evaluations.get(_key(fill, length))
+
+    def record_evaluation(self, fill, length, result):
+        key = _key(fill, length)
+        if key in self.evaluations:
+            return
+        record = {k: float(result[k]) for k in ('f0', 'qc', 'qi') if k in result}
+        self.evaluations[key] = record
+        self._append(dict(type='evaluation', fill=key[0], length=key[1], **record))
+
+    def row_done(self, fill):
+        return _key(fill) in self.rows
+
+    def row(self, fill):
+        return self.rows.get(_key(fill))
+
+    def record_row(self, fill, accepted=None):
+        # 'accepted' is None if no length of the row matched the target
+        if accepted is not None:
+            accepted = {k: (v if isinstance(v, str) else float(v)) for k, v in accepted.items()}
+        self.rows[_key(fill)] = accepted
+        self._append(dict(type='row', fill=_key(fill)[0], accepted=accepted))
+
+    def record_export(self, name):
+        self.exports.add(name)
+        self._append(dict(type='export', name=name))
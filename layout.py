@@ -0,0 +1,128 @@
+import functools
+import numpy as np
+import gdstk
+
+
+def cached_cell(builder):
+    # Memoize a cell builder on its keyword arguments. Identical parameter
+    # sets return the same gdstk.Cell, so callers must not modify it.
+    @functools.lru_cache(maxsize=4096)
+    def build(items):
+        return builder(**dict(items))
+
+    @functools.wraps(builder)
+    def wrapper(**kwargs):
+        items = tuple(sorted(kwargs.items()))
+        try:
+            hash(items)
+        except TypeError:  # unhashable parameters are never cached
+            return builder(**kwargs)
+        return build(items)
+
+    wrapper.cache_info = build.cache_info
+    wrapper.cache_clear = build.cache_clear
+    return wrapper
+
+
+def rectangles(x1, y1, x2, y2):
+    # vertices of many rectangles at once with the same ordering as gdstk.rectangle
+    x1, y1, x2, y2 = np.broadcast_arrays(*(np.asarray(v, dtype=float) for v in (x1, y1, x2, y2)))
+    return np.stack([np.stack([x1, y1], axis=-1), np.stack([x2, y1], axis=-1),
+                     np.stack([x2, y2], axis=-1), np.stack([x1, y2], axis=-1)], axis=-2)
+
+
+class CapacitorLayout:
+    # Resolves the offsets of the interdigitated capacitor once so that the
+    # geometry builders don't recompute them for every feature.
+    def __init__(self, ground1_width, gap, center_width, ground2_width, bottom_ground_height,
+                 coupling_bar_gap, coupling_bar_width, coupling_bar_height_max, left_bar_width, bar_gap,
+                 bar_height, bar_width, finger_gap, finger_width, finger_pairs):
+        self.coupling_bar_height_max = coupling_bar_height_max
+        self.left_bar_width = left_bar_width
+        self.bar_gap = bar_gap
+        self.bar_height = bar_height
+        self.bar_width = bar_width
+        self.finger_gap = finger_gap
+        self.finger_width = finger_width
+        self.finger_pairs = finger_pairs
+        self.fingers = 2 * finger_pairs
+        self.right_bar_width = bar_width - left_bar_width - bar_gap
+
+        # x offsets
+        self.x_coupling_bar = ground1_width + gap + center_width + gap + ground2_width + coupling_bar_gap
+        self.x_left_bar = self.x_coupling_bar + coupling_bar_width  # fingers start here
+        self.x_bar_gap = self.x_left_bar + left_bar_width  # start of the gap between the bars
+        self.x_right_bar = self.x_bar_gap + bar_gap
+        self.x_far_side = self.x_left_bar + bar_width  # the right fingers start here
+
+        # y offsets
+        self.y_bottom = bottom_ground_height + coupling_bar_gap
+        self.y_center = self.y_bottom + coupling_bar_height_max / 2
+        self.y_fingers = self.y_center + finger_gap
+
+    def coupling_bar(self, coupling_bar_height):
+        return gdstk.rectangle((self.x_coupling_bar, self.y_bottom + self.coupling_bar_height_max),
+                               (self.x_left_bar, self.y_bottom + coupling_bar_height))
+
+    def bars(self):
+        # left bar and the right bar wrapping around the fingers
+        left = gdstk.FlexPath((self.x_left_bar, self.y_center - self.bar_height / 2), self.bar_height)
+        left = left.horizontal(self.x_bar_gap, self.bar_height)
+        right = gdstk.FlexPath((self.x_right_bar, self.y_center - self.bar_height / 2), self.bar_height)
+        right = right.horizontal(self.x_right_bar + self.right_bar_width + self.bar_height / 2, self.bar_height)
+        right = right.vertical(self.y_center + self.fingers * (self.finger_gap + self.finger_width))
+        return left, right
+
+    def patches(self, spacing_between_inductor_waveguide, inductor_width):
+        # rectangles used to transition into the inductor
+        y1 = self.y_center - self.bar_height
+        y2 = y1 - spacing_between_inductor_waveguide - inductor_width
+        patch1 = gdstk.rectangle((self.x_bar_gap, y1), (self.x_bar_gap - self.bar_height, y2))
+        patch2 = gdstk.rectangle((self.x_right_bar, y1), (self.x_right_bar + self.bar_height, y2))
+        return patch1, patch2
+
+    def added_fill(self, fill, base_fill, max_fill):
+        # Fill of each finger pair: the pairs are filled to 'max_fill' one after
+        # the other until 'fill' is used up and the rest are kept at 'base_fill'.
+        k = np.arange(self.finger_pairs)
+        return np.maximum(np.minimum(max_fill, fill - k * max_fill), base_fill)
+
+    def finger_polygons(self, added_fill):
+        # Fingers alternate between the left and right bars, each pair using
+        # the fill of 'added_fill'. All of them are generated in one pass.
+        j = np.arange(self.fingers)
+        fill = np.repeat(added_fill, 2)
+        left = j % 2 == 0
+        y1 = self.y_fingers + j * (self.finger_gap + self.finger_width)
+        x1 = np.where(left, self.x_left_bar, self.x_far_side)
+        x2 = np.where(left, self.x_left_bar + fill - self.finger_width,
+                      self.x_far_side - fill + self.finger_width)
+        return [gdstk.Polygon(points) for points in rectangles(x1, y1, x2, y1 + self.finger_width)]
+
+
+def taper(x0, y0, widths, step, tolerance=0):
+    # Vertices of a single polygon with a flat bottom edge at y0 and a top
+    # edge that steps through 'widths', one every 'step' from x0. This is the
+    # outline of one rectangle per width. Neighboring widths are merged while
+    # they stay within 'tolerance' of each other. A merged step gets the
+    # harmonic mean of its widths so the integral of dx / w (the inductance)
+    # is unchanged. With tolerance=0 only repeated widths are merged.
+    widths = np.asarray(widths, dtype=float)
+    if tolerance > 0:
+        starts = [0]
+        low = high = widths[0]
+        for index, width in enumerate(widths[1:], 1):
+            low, high = min(low, width), max(high, width)
+            if high - low > tolerance:
+                starts.append(index)
+                low = high = width
+        starts = np.array(starts)
+    else:
+        starts = np.flatnonzero(np.r_[True, np.diff(widths) != 0])
+    counts = np.diff(np.r_[starts, len(widths)])
+    heights = counts / np.add.reduceat(1 / widths, starts)
+    x = x0 + step * np.r_[starts, len(widths)]
+    y = y0 + heights
+    # the top edge runs from right to left: (x[j + 1], y[j]), (x[j], y[j])
+    top = np.stack([np.stack([x[1:], y], axis=-1), np.stack([x[:-1], y], axis=-1)], axis=1)
+    return np.concatenate([[(x[0], y0), (x[-1], y0)], top[::-1].reshape(-1, 2)])
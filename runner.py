@@ -0,0 +1,149 @@
+import os
+import re
+import time
+import asyncio
+import logging
+import psutil
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+sonnet_path = '/opt/sonnet'
+
+
+async def _drain(stream, write, lines=None):
+    # forward every line of a pipe to the logger as soon as it arrives
+    while True:
+        line = await stream.readline()
+        if not line:
+            break
+        line = line.decode('utf-8', errors='replace').strip()
+        if line:
+            write(line)
+            if lines is not None:
+                lines.append(line)
+
+
+def _tree(pid):
+    try:
+        process = psutil.Process(pid)
+        return [process] + process.children(recursive=True)
+    except psutil.NoSuchProcess:
+        return []
+
+
+async def _monitor(pid, usage, interval):
+    # Sample the CPU time and memory of the process and its children until
+    # it is cancelled. The CPU time of a process includes the children it
+    # has already waited for, so children that exited between two samples
+    # are still counted. The largest samples are what gets reported.
+    while True:
+        cpu_time = 0.
+        rss = 0
+        for process in _tree(pid):
+            try:
+                with process.oneshot():
+                    times = process.cpu_times()
+                    cpu_time += times.user + times.system + times.children_user + times.children_system
+                    rss += process.memory_info().rss
+            except psutil.NoSuchProcess:
+                continue
+        usage['cpu_time'] = max(usage['cpu_time'], cpu_time)
+        usage['peak_rss'] = max(usage['peak_rss'], rss)
+        await asyncio.sleep(interval)
+
+
+def _kill(pid):
+    for process in reversed(_tree(pid)):
+        try:
+            process.kill()
+        except psutil.NoSuchProcess:
+            pass
+
+
+async def run_async(command, timeout=None, logger=None, interval=0.5):
+    # Run a command line tool while draining stdout (logged as info) and
+    # stderr (logged as error) concurrently. The process and its children are
+    # killed on a timeout (raises TimeoutError) or when the task is cancelled.
+    # Returns a dictionary with the return code, the lines written to stdout,
+    # the wall time, CPU time and peak resident memory (both sampled every
+    # 'interval' seconds, so runs shorter than that may report no CPU time).
+    logger = logger or log
+    command = [str(part) for part in command]
+    start = time.perf_counter()
+    process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE,
+                                                   stderr=asyncio.subprocess.PIPE)
+    output = []
+    usage = dict(cpu_time=0., peak_rss=0)
+    monitor = asyncio.create_task(_monitor(process.pid, usage, interval))
+    try:
+        await asyncio.wait_for(asyncio.gather(_drain(process.stdout, logger.info, output),
+                                              _drain(process.stderr, logger.error),
+                                              process.wait()), timeout)
+    except asyncio.TimeoutError:
+        _kill(process.pid)
+        await process.wait()
+        raise TimeoutError(f"'{os.path.basename(command[0])}' timed out after {timeout:g} s")
+    except asyncio.CancelledError:
+        _kill(process.pid)
+        await process.wait()
+        raise
+    finally:
+        monitor.cancel()
+    result = dict(command=command, returncode=process.returncode, output=output,
+                  wall_time=time.perf_counter() - start, **usage)
+    logger.debug(f"{os.path.basename(command[0])}: {result['wall_time']:.1f} s wall, "
+                 f"{result['cpu_time']:.1f} s cpu, {result['peak_rss'] / 2**20:.0f} MiB peak")
+    return result
+
+
+async def run_many_async(commands, limit=None, return_exceptions=False, **kwargs):
+    # Run the commands with at most 'limit' of them at once. With
+    # return_exceptions=True a failed run (e.g. a timeout) returns its
+    # exception in place of its result instead of raising.
+    semaphore = asyncio.Semaphore(limit or len(commands) or 1)
+
+    async def limited(command):
+        async with semaphore:
+            return await run_async(command, **kwargs)
+
+    return await asyncio.gather(*(limited(command) for command in commands), return_exceptions=return_exceptions)
+
+
+def run(command, **kwargs):
+    return asyncio.run(run_async(command, **kwargs))
+
+
+def run_many(commands, limit=None, return_exceptions=False, **kwargs):
+    return asyncio.run(run_many_async(commands, limit=limit, return_exceptions=return_exceptions, **kwargs))
+
+
+def check(result):
+    # raise if a command returned a nonzero exit code
+    if result['returncode'] != 0:
+        name = os.path.basename(result['command'][0])
+        raise RuntimeError(f"{name} failed on {result['command'][-1]} with exit code {result['returncode']}")
+    return result
+
+
+def run_em(son_file, **kwargs):
+    # solve a sonnet project with the em command line solver
+    return check(run([os.path.join(sonnet_path, 'bin', 'em'), son_file], **kwargs))
+
+
+_frequency = re.compile(r'(\d+(?:\.\d*)?(?:[eE][-+]?\d+)?)\s*(GHz|MHz|kHz|Hz)\b')
+_units = dict(GHz=1., MHz=1e-3, kHz=1e-6, Hz=1e-9)
+
+
+def analysed_frequencies(result):
+    # The frequencies (GHz) em reports analysing in the output of run_em:
+    # every value with a frequency unit on a line that mentions a frequency.
+    # Not yet checked against a real em log; an empty list means the export
+    # falls back to simulating at f0.
+    frequencies = set()
+    for line in result['output']:
+        if 'freq' not in line.lower():
+            continue
+        for value, unit in _frequency.findall(line):
+            frequencies.add(round(float(value) * _units[unit], 9))
+    return sorted(frequencies)
@@ -0,0 +1,401 @@
+import logging
+import pathlib
+from collections import deque
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+import numpy as np
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+directory = pathlib.Path(__file__).parent.absolute()
+
+
+def pixel_name(fill, length):
+    return f"pixel_{abs(fill):g}_{length:g}".replace('.', 'd')
+
+
+def row_folder(folder, fill):
+    # output folder of a fill row in the parallel sweep
+    return pathlib.Path(folder) / f"fill_{abs(fill):g}".replace('.', 'd')
+
+
+def accepted_pixel(fill, length, result):
+    # the journal record of the accepted pixel of a row; 'name' is the name of
+    # its current density export and 'sweep' the name of its sweep project
+    name = f"pixel_{result['f0']:g}_{result['qc']:g}".replace('.', 'd')
+    return dict(length=length, f0=result['f0'], qc=result['qc'], qi=result['qi'], name=name,
+                sweep=pixel_name(fill, length))
+
+
+def sweep_parameters(qc_target, tolerance, length_array, search, **kwargs):
+    # the settings a journaled sweep depends on (see journal.Journal)
+    return dict(qc_target=qc_target, tolerance=tolerance, lengths=[float(length) for length in length_array],
+                search=search, **{k: kwargs.get(k) for k in ('epsilon', 'f1', 'f2')})
+
+
+def evaluate(name, folder, prior=None, **kwargs):
+    # simulate a single pixel and fit it (runs inside a worker process)
+    from fitting import find_resonance, fit  # imported in the worker that needs them
+    resonance = find_resonance(name, folder=folder, **kwargs)
+    return fit(name, folder=folder, prior=prior, data=resonance['data'])
+
+
+def simulate(name, folder, **kwargs):
+    # simulation stage of the pipeline (runs inside a worker process), the
+    # loaded data is handed to the fit stage
+    from fitting import find_resonance
+    return find_resonance(name, folder=folder, **kwargs)['data']
+
+
+def prepare_export(name, folder, capacitor_kwargs, f0, sweep=None, bandwidth=None, **kwargs):
+    # Export stage: get a solved project to export the current density of the
+    # accepted pixel from at its resonance frequency. If 'sweep' names the
+    # pixel's solved sweep project, it is used at the frequency em analysed
+    # nearest to f0 if that is within 'bandwidth' (GHz) of f0. Otherwise, or
+    # if only the cached touchstone file of the sweep is available, the pixel
+    # is simulated again at f0. 'kwargs' are passed to single_pixel. Returns
+    # the export_current_density keywords of the export.
+    from cache import solved_frequencies
+    if sweep is not None and bandwidth is not None:
+        frequencies = solved_frequencies(directory / folder / f"{sweep}.ts")
+        if frequencies is None:
+            log.info(f"{name}: the solved frequencies of {sweep}.son are not known, simulating at f0")
+        else:
+            frequency = min(frequencies, key=lambda f: abs(f - f0))
+            if abs(frequency - f0) <= bandwidth:
+                log.info(f"{name}: exporting from {sweep}.son at {frequency:g} GHz (f0 = {f0:g} GHz)")
+                return dict(folder=folder, xml_name=name, csv_name=f"{name}.csv", son_label=f"{sweep}.son",
+                            frequency=str(int(round(frequency * 10**9))))
+            log.info(f"{name}: {sweep}.son was solved {abs(frequency - f0) * 1e6:.0f} kHz from f0 at the "
+                     f"closest, simulating at f0")
+    from simulation import single_pixel
+    # an export interrupted before it was journaled left its files behind
+    single_pixel(name, single_freq=True, folder=folder, capacitor_kwargs=capacitor_kwargs,
+                 f1=round(f0, 4), **dict(kwargs, overwrite=True))
+    return dict(folder=folder, xml_name=name, csv_name=f"{name}.csv", son_label=f"{name}.son",
+                frequency=str(int(round(f0, 4) * 10**9)))
+
+
+def export_pixel(name, folder, capacitor_kwargs, f0, sweep=None, bandwidth=None, **kwargs):
+    # prepare_export and export the current density of a single pixel
+    from current import export_current_density
+    export_current_density(**prepare_export(name, folder, capacitor_kwargs, f0, sweep=sweep,
+                                            bandwidth=bandwidth, **kwargs))
+    return name
+
+
+class PixelJob:
+    # A pixel going through the simulate -> fit pipeline. Without a fit
+    # executor both stages run in the same task on the simulation executor.
+    # Otherwise the fit is queued on 'fit_executor' as soon as the simulation
+    # finishes so the simulation worker can start on the next pixel. 'prior'
+    # is a neighboring fit result used to warm start the fit.
+    def __init__(self, executor, fit_executor, name, folder, prior=None, **kwargs):
+        if fit_executor is None:
+            self.simulation = executor.submit(evaluate, name, folder, prior=prior, **kwargs)
+            self.fitted = self.simulation
+            return
+        self.fitted = Future()
+        self.simulation = executor.submit(simulate, name, folder, **kwargs)
+
+        def fitted(future):
+            if future.exception() is not None:
+                self.fitted.set_exception(future.exception())
+            else:
+                self.fitted.set_result(future.result())
+
+        def simulated(future):
+            if future.cancelled():
+                self.fitted.cancel()
+            elif future.exception() is not None:
+                self.fitted.set_exception(future.exception())
+            else:
+                from fitting import fit
+                try:
+                    fit_future = fit_executor.submit(fit, name, folder=folder, prior=prior, data=future.result())
+                except RuntimeError as error:  # the fit executor was shut down first
+                    self.fitted.set_exception(error)
+                    return
+                fit_future.add_done_callback(fitted)
+
+        self.simulation.add_done_callback(simulated)
+
+    replayed = False  # True if the result comes from the journal instead of a simulation
+
+    @classmethod
+    def finished(cls, result):
+        # a job whose result is already known (e.g. from the sweep journal)
+        job = cls.__new__(cls)
+        job.simulation = job.fitted = Future()
+        job.fitted.set_result(result)
+        job.replayed = True
+        return job
+
+    def result(self):
+        return self.fitted.result()
+
+    def cancel(self):
+        return self.simulation.cancel()
+
+
+def submit_pixel(executor, fit_executor, journal, fill, length, folder, **kwargs):
+    # start a pixel job unless its result is already in the journal
+    if journal is not None:
+        result = journal.evaluation(fill, length)
+        if result is not None:
+            return PixelJob.finished(result)
+    return PixelJob(executor, fit_executor, pixel_name(fill, length), folder, **kwargs)
+
+
+def sweep_row(executor, fill, length_array, qc_target, tolerance, folder, workers=1, fit_executor=None,
+              journal=None, **kwargs):
+    # Scan the coupling lengths of one fill row in order while keeping up to
+    # 'workers' simulations in flight on the executor. Results are consumed in
+    # length order so the early break on Qc behaves exactly like the serial
+    # loop. Only 'workers' simulations are submitted at a time, so they are
+    # all running when the row ends: a process pool can't stop them, they
+    # finish (holding their sonnet licence) and their results are discarded.
+    # Returns (accepted, results, number of simulations run), the journaled
+    # results replayed on a resume are not counted as simulations.
+    capacitor_kwargs = kwargs.pop('capacitor_kwargs', {})
+    lengths = iter(length_array)
+    pending = deque()  # (length, job) in submission order
+    results = []  # (length, fit result) for every evaluated length
+    accepted = None
+    simulations = 0
+
+    def submit():
+        nonlocal simulations
+        length = next(lengths, None)
+        if length is None:
+            return False
+        cap = dict(capacitor_kwargs, fill=fill, coupling_bar_height=length)
+        # the previous length's resonance predicts this one
+        prior = results[-1][1] if results else None
+        f0_guess = prior['f0'] if prior is not None else None
+        job = submit_pixel(executor, fit_executor, journal, fill, length, folder,
+                           capacitor_kwargs=cap, f0_guess=f0_guess, prior=prior, **kwargs)
+        pending.append((length, job))
+        simulations += not job.replayed
+        return True
+
+    def simulating():
+        return [job.simulation for _, job in pending if not job.simulation.done()]
+
+    try:
+        while True:
+            # keep the simulation workers busy while earlier lengths are fitted
+            while len(simulating()) < max(1, workers) and submit():
+                pass
+            if not pending:
+                break
+            length, job = pending[0]
+            wait([job.fitted] + simulating(), return_when=FIRST_COMPLETED)
+            if not job.fitted.done():
+                continue
+            pending.popleft()
+            result = job.result()
+            results.append((length, result))
+            if journal is not None:
+                journal.record_evaluation(fill, length, result)
+            log.info(f"fill {fill:g}, length {length:g}: f0 = {result['f0']:g}, qc = {result['qc']:g}")
+            if result['qc'] < qc_target - tolerance:
+                break
+            elif abs(result['qc'] - qc_target) < tolerance:
+                accepted = (length, result)
+                break
+    finally:
+        for _, job in pending:
+            if job.cancel():  # only stops jobs that have not started
+                simulations -= 1
+        running = len(simulating())
+        if running:
+            log.info(f"fill {fill:g}: discarding {running} lengths that are still simulating")
+
+    return accepted, results, simulations
+
+
+def search_row(executor, fill, length_array, qc_target, tolerance, folder, surrogate=None,
+               verifications=2, fit_executor=None, journal=None, **kwargs):
+    # Find the coupling length of one fill row whose Qc is within 'tolerance'
+    # of 'qc_target'. If a surrogate is given, its predictions are simulated
+    # first ('verifications' at most) and it is updated with every result.
+    # Otherwise, or if that fails, a bracketed secant search on log(Qc) is
+    # used. Qc is monotonic in the coupling bar height, so the two ends of
+    # 'length_array' bracket the target if it can be reached at all.
+    # Candidates are indices into 'length_array', which keeps every simulated
+    # length on the sonnet grid. A resumed row starts from the results in the
+    # journal, which the surrogate is expected to hold already. Returns
+    # (accepted, results, number of simulations run).
+    capacitor_kwargs = kwargs.pop('capacitor_kwargs', {})
+    evaluated = {}  # index -> fit result
+    results = []  # (length, fit result) in evaluation order
+    simulations = 0  # results that were simulated, not replayed from the journal
+    if journal is not None:
+        for index, length in enumerate(length_array):
+            result = journal.evaluation(fill, length)
+            if result is not None:
+                evaluated[index] = result
+                results.append((length, result))
+        if evaluated:
+            log.info(f"fill {fill:g}: resuming from {len(evaluated)} journaled lengths")
+
+    def f0_guess(index):
+        # predict the resonance from the surrogate or the nearest result in this row
+        if surrogate is not None:
+            prediction = surrogate.predict(fill, length_array[index])
+            if prediction is not None and np.isfinite(prediction[0]):
+                return float(prediction[0])
+        if evaluated:
+            nearest = min(evaluated, key=lambda i: abs(i - index))
+            return evaluated[nearest]['f0']
+        return None
+
+    def prior(index):
+        # the fit of the nearest length simulated in this row warm starts the fit
+        if not evaluated:
+            return None
+        return evaluated[min(evaluated, key=lambda i: abs(i - index))]
+
+    def evaluate_indices(*indices):
+        nonlocal simulations
+        indices = [index for index in indices if index not in evaluated]
+        jobs = []
+        for index in indices:
+            length = length_array[index]
+            cap = dict(capacitor_kwargs, fill=fill, coupling_bar_height=length)
+            jobs.append(submit_pixel(executor, fit_executor, journal, fill, length, folder,
+                                     capacitor_kwargs=cap, f0_guess=f0_guess(index), prior=prior(index),
+                                     **kwargs))
+        for index, job in zip(indices, jobs):
+            result = job.result()
+            evaluated[index] = result
+            results.append((length_array[index], result))
+            simulations += not job.replayed
+            if journal is not None:
+                journal.record_evaluation(fill, length_array[index], result)
+            if surrogate is not None and not job.replayed:  # journaled results are already in it
+                surrogate.add(fill, length_array[index], result['f0'], result['qc'])
+            log.info(f"fill {fill:g}, length {length_array[index]:g}: "
+                     f"f0 = {result['f0']:g}, qc = {result['qc']:g}")
+
+    def matched(index):
+        return abs(evaluated[index]['qc'] - qc_target) < tolerance
+
+    def residual(index):
+        return np.log(evaluated[index]['qc'] / qc_target)
+
+    def report(index):
+        if index is None:
+            log.info(f"fill {fill:g}: no match after {simulations} simulations")
+            return None, results, simulations
+        log.info(f"fill {fill:g}: match at length {length_array[index]:g} after {simulations} simulations")
+        return (length_array[index], evaluated[index]), results, simulations
+
+    # a match may have been journaled before the row was
+    for index in sorted(evaluated):
+        if matched(index):
+            return report(index)
+
+    # verify the surrogate's predictions
+    if surrogate is not None:
+        for _ in range(verifications):
+            index = surrogate.suggest(fill, length_array, qc_target)
+            if index is None or index in evaluated:
+                break
+            evaluate_indices(index)
+            if matched(index):
+                return report(index)
+
+    # bracket the target with the results so far, adding the ends if needed
+    def bracket():
+        indices = sorted(evaluated)
+        for lo, hi in zip(indices[:-1], indices[1:]):
+            if residual(lo) * residual(hi) <= 0:
+                return lo, hi
+        return None
+
+    lo_hi = bracket()
+    if lo_hi is None:
+        evaluate_indices(0, len(length_array) - 1)
+        for index in (0, len(length_array) - 1):
+            if matched(index):
+                return report(index)
+        lo_hi = bracket()
+    if lo_hi is None:
+        qc = [result['qc'] for result in evaluated.values()]
+        log.warning(f"fill {fill:g}: qc target is outside of [{min(qc):g}, {max(qc):g}]")
+        return report(None)
+    lo, hi = lo_hi
+    g_lo, g_hi = residual(lo), residual(hi)
+
+    moved = None  # which end of the bracket moved last
+    while hi - lo > 1:
+        # secant step snapped to the grid; fall back to bisection when the
+        # same end of the bracket moved twice in a row (slow convergence)
+        index = int(round(lo + g_lo * (hi - lo) / (g_lo - g_hi)))
+        if moved == 'twice':
+            index = (lo + hi) // 2
+        index = min(max(index, lo + 1), hi - 1)
+        evaluate_indices(index)
+        if matched(index):
+            return report(index)
+        g = residual(index)
+        side = 'lo' if g * g_lo > 0 else 'hi'
+        moved = 'twice' if side == moved else side
+        if side == 'lo':
+            lo, g_lo = index, g
+        else:
+            hi, g_hi = index, g
+    return report(None)
+
+
+def run_row(fill, length_array, qc_target, tolerance, folder, search='secant', resume=True,
+            export_source='sweep', shape_tolerance=1e-3, **kwargs):
+    # Worker of the parallel sweep: search one fill row from start to finish
+    # (runs inside its own process). The row shares nothing with the other
+    # rows. It has its own output folder, journal and log file, and it runs
+    # one simulation at a time, so a pool of N row workers never uses more
+    # than N sonnet licences. The accepted pixel is exported before returning
+    # (fill, accepted, number of simulations); a failed export is logged and
+    # left out of the journal. An export from the sweep has to be within
+    # 'shape_tolerance' * f0 of f0 (see fine_grid.py and prepare_export).
+    from concurrent.futures import ThreadPoolExecutor
+    from journal import Journal
+    folder = row_folder(folder, fill)
+    (directory / folder).mkdir(parents=True, exist_ok=True)
+    handler = logging.FileHandler(directory / folder / "row.log")
+    handler.setFormatter(logging.Formatter("%(asctime)s %(name)s %(levelname)s: %(message)s"))
+    root = logging.getLogger()
+    root.addHandler(handler)  # pool processes are reused, so the handler is removed again below
+    try:
+        parameters = sweep_parameters(qc_target, tolerance, length_array, search, **kwargs)
+        journal = Journal(directory / folder / "journal.jsonl", resume=resume, parameters=parameters)
+        count = 0
+        if journal.row_done(fill):
+            accepted = journal.row(fill)
+            log.info(f"fill {fill:g}: already done")
+        else:
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                if search == 'linear':
+                    accepted, _, count = sweep_row(executor, fill, length_array, qc_target, tolerance, folder,
+                                                   journal=journal, **kwargs)
+                else:
+                    accepted, _, count = search_row(executor, fill, length_array, qc_target, tolerance, folder,
+                                                    journal=journal, **kwargs)
+            if accepted is not None:
+                accepted = accepted_pixel(fill, *accepted)
+            journal.record_row(fill, accepted)
+        if accepted is not None and accepted['name'] not in journal.exports:
+            cap = dict(coupling_bar_height=accepted['length'], fill=fill)
+            sweep = accepted.get('sweep') if export_source == 'sweep' else None
+            single_kwargs = {k: kwargs[k] for k in ('epsilon', 'em_runner') if k in kwargs}
+            try:
+                journal.record_export(export_pixel(accepted['name'], folder, cap, accepted['f0'], sweep=sweep,
+                                                   bandwidth=shape_tolerance * accepted['f0'], **single_kwargs))
+            except Exception:  # the row is done, the export is retried when the sweep is resumed
+                log.exception(f"fill {fill:g}: exporting {accepted['name']} failed")
+        return fill, accepted, count
+    finally:
+        root.removeHandler(handler)
+        handler.close()
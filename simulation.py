@@ -1,41 +1,39 @@
-import os
+import copy
+import functools
 import logging
 import pathlib
 from pathlib import Path
-import numpy as np
-import pysonnet as ps
-from Resonator import feedline, capacitor, inductor
-import gdstk
-import loopfit as lf
-import matplotlib.pyplot as plt
+from cache import simulation_key, clear_keys, write_solved
 
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
 
 
 def simulation(name, epsilon=9.3, inductor_kwargs=None, capacitor_kwargs=None,
-               feedline_kwargs=None, **kwargs):
-    if inductor_kwargs is None:
-        inductor_kwargs = {}
-    if capacitor_kwargs is None:
-        capacitor_kwargs = {}
-    if feedline_kwargs is None:
-        feedline_kwargs = {}
+               feedline_kwargs=None, plot=True, **kwargs):
+    # Simulate a pixel in sonnet/testing and fit the full band. The fit is
+    # only plotted if 'plot' is True, so this can also run headless.
+    kwargs.setdefault('folder', 'sonnet/testing')
+    postprocess = [fit_result, plot_fit] if plot else [fit_result]
+    results = {}
+    _, simulation_name = single_pixel(name, epsilon=epsilon, inductor_kwargs=inductor_kwargs,
+                                      capacitor_kwargs=capacitor_kwargs, feedline_kwargs=feedline_kwargs,
+                                      postprocess=postprocess, results=results, **kwargs)
+    keys = ["f0", "qi", "qc"]
+    print(*[key + f": {results['fit'][key]:g}" for key in keys])
 
-    dx = kwargs.get('dx', 0.5)  # grid size
-    dy = kwargs.get('dy', 0.5)
-    f1 = kwargs.get('f1', 4)  # starting and ending freq
-    f2 = kwargs.get('f2', 8)
-    overwrite = kwargs.get('overwrite', False)
-    height = kwargs.get("height", 200)  # pixel height in the y axis
-    center_width = kwargs.get("center_width", 8)  # feedline width in x axis
-    gap = kwargs.get("gap", 3)  # gap between the ground plane and center strip
+    return simulation_name
+
+
+def _setup_project(epsilon, dx, dy, height, center_width, gap, feedline_kwargs):
+    # Everything in the sonnet project that does not change between pixels:
+    # the box, dielectrics, options, metals, feedline geometry and ports.
+    import pysonnet as ps  # delay pysonnet import
+    from Resonator import feedline
     ground1_width = 50 * center_width  # left side of center strip
 
     feed_geom = feedline(**feedline_kwargs)
-    cap_geom = capacitor(**capacitor_kwargs)
-    ind_geom = inductor(**inductor_kwargs)
-    bbox = feed_geom.bounding_box()  # box around the feedline cells
+    bbox = feed_geom.bounding_box()
     box_x = bbox[1][0] - bbox[0][0]
     box_y = bbox[1][1] - bbox[0][1]
 
@@ -50,10 +48,9 @@ def simulation(name, epsilon=9.3, inductor_kwargs=None, capacitor_kwargs=None,
     project.add_dielectric("sapphire", level=1, thickness=525, epsilon=epsilon,
                            dielectric_loss=1e-9, conductivity=0)
 
-    # Set up the sweep.
+    # Set up the analysis (the sweep itself is added per pixel).
     project.set_options(q_accuracy=True, resonance_detection=True,
                         current_density=True)
-    project.add_frequency_sweep("abs", f1=f1, f2=f2)
     project.set_analysis("frequency sweep")
     project['control']['speed'] = 1  # medium memory
 
@@ -67,9 +64,7 @@ def simulation(name, epsilon=9.3, inductor_kwargs=None, capacitor_kwargs=None,
     project.define_technology_layer("metal", "feedline", 0, "Nb",
                                     fill_type="diagonal")
 
-    # Add the geometry
-    project.add_gdstk_cell("metal", cap_geom, layer=0, tech_layer="capacitor")
-    project.add_gdstk_cell("metal", ind_geom, layer=0, tech_layer="inductor")
+    # Add the feedline geometry
     project.add_gdstk_cell("metal", feed_geom, layer=0, tech_layer="feedline")
 
     # Add ports
@@ -78,39 +73,27 @@ def simulation(name, epsilon=9.3, inductor_kwargs=None, capacitor_kwargs=None,
     project.add_port("standard", 2, x=ground1_width + gap + center_width / 2, y=height,
                      resistance=50)
     project.add_output_file("touchstone2")
+    return project, feed_geom
 
-    # Create the file name and raise an error if it's already been simulated.
-    directory = pathlib.Path(__file__).parent.absolute()
-    simulation_name = directory / f"sonnet/testing/{name}.son"
-    output_name = simulation_name.parent / f"{name}.ts"
-    log.info(f"Simulating {simulation_name}")
-    if os.path.isfile(output_name) and not overwrite:
-        raise IOError(f"{output_name} already exists")
-
-    # Create the sonnet file and run.
-    project.make_sonnet_file(simulation_name)
-    project.run()
-
-    # fit the touchstone file
-    folder = pathlib.Path(directory / 'sonnet/testing')
-    f, i, q = lf.load_touchstone(folder / f"{name}.ts")  # grab file from folder
-    guess = lf.guess(f, i, q, phase0=0, phase1=0)
-    result = lf.fit(f, i, q, **guess)
-    print(result['summary'])
-    model = lf.model(f, **result)
-    plt.plot(i, q, 'o', markersize=2, label='data')
-    plt.plot(model.real, model.imag, label='fit')
-    plt.legend()
-    plt.axis('equal')
-    keys = ["f0", "qi", "qc"]
-    print(*[key + f": {result[key]:g}" for key in keys])
 
-    return simulation_name
+@functools.lru_cache(maxsize=32)
+def _project_template(epsilon, dx, dy, height, center_width, gap, feedline_items):
+    return _setup_project(epsilon, dx, dy, height, center_width, gap, dict(feedline_items))
+
+
+def project_template(epsilon, dx, dy, height, center_width, gap, feedline_kwargs):
+    # A copy of the invariant part of the project, built once per set of
+    # parameters. Returns the project and the feedline cell.
+    template, feed_geom = _project_template(epsilon, dx, dy, height, center_width, gap,
+                                            tuple(sorted(feedline_kwargs.items())))
+    return copy.deepcopy(template), feed_geom
 
 
 def single_pixel(name, epsilon=None, inductor_kwargs=None, capacitor_kwargs=None,
                  feedline_kwargs=None, **kwargs):
 
+    from Resonator import capacitor, inductor  # delay gdstk import
+
     # epsilon for silicon is 11.2, for sapphire it is 9.3
     if inductor_kwargs is None:
         inductor_kwargs = {}
@@ -123,6 +106,10 @@ def single_pixel(name, epsilon=None, inductor_kwargs=None, capacitor_kwargs=None
     run = kwargs.get('run', True)
     folder = pathlib.Path(kwargs.get("folder", "sonnet/testing/"))
     single_freq = kwargs.get('single_freq', False) # sets the initial condition for single freq simulation
+    cache = kwargs.get('cache', None)  # SimulationCache used to skip already simulated geometries
+    em_runner = kwargs.get('em_runner', False)  # run em through runner.run_em instead of project.run()
+    timeout = kwargs.get('timeout', None)  # seconds before an em_runner simulation is killed
+    template = kwargs.get('template', True)  # start from a copy of the cached invariant project
 
     dx = kwargs.get('dx', 0.5)  # grid size
     dy = kwargs.get('dy', 0.5)
@@ -132,78 +119,109 @@ def single_pixel(name, epsilon=None, inductor_kwargs=None, capacitor_kwargs=None
     height = kwargs.get("height", 200)  # pixel height in the y axis
     center_width = kwargs.get("center_width", 8)  # center strip width in x axis
     gap = kwargs.get("gap", 3)  # gap from ground planes
-    ground1_width = 50 * center_width  # left side of center strip
 
-    feed_geom = feedline(**feedline_kwargs)
+    if template:
+        project, feed_geom = project_template(epsilon, dx, dy, height, center_width, gap, feedline_kwargs)
+    else:
+        project, feed_geom = _setup_project(epsilon, dx, dy, height, center_width, gap, feedline_kwargs)
     cap_geom = capacitor(**capacitor_kwargs)
     ind_geom = inductor(**inductor_kwargs)
-    bbox = feed_geom.bounding_box()
-    box_x = bbox[1][0] - bbox[0][0]
-    box_y = bbox[1][1] - bbox[0][1]
 
-    project = ps.GeometryProject()  # creates a project using the GeometryProject function in pysonnet
-    project.setup_box(box_x, box_y, box_x / dx, box_y / dy)  # x width, y width, x cells, y cells
-    project.set_units(length='um')
-    project.set_box_cover("free space", top=True)
-    project.set_box_cover("free space", bottom=True)
-
-    # Define the dielectrics.
-    project.add_dielectric("air", level=0, thickness=5000, epsilon=1)
-    project.add_dielectric("sapphire", level=1, thickness=525, epsilon=epsilon,
-                           dielectric_loss=1e-9, conductivity=0)
-
-    # Set up the sweep.
-    project.set_options(q_accuracy=True, resonance_detection=True,
-                        current_density=True)
     # determine which sweep to use
     if single_freq == True:
         project.add_frequency_sweep("single", f1=f1)
     else:
         project.add_frequency_sweep("abs", f1=f1, f2=f2)
-    project.set_analysis("frequency sweep")
-    project['control']['speed'] = 1  # medium memory
-
-    # Define the metal layers.
-    project.define_metal("general", "Hf", ls=13, r_dc=0)
-    project.define_metal("general", "Nb", ls=0.1, r_dc=0)
-    project.define_technology_layer("metal", "inductor", 0, "Hf",
-                                    fill_type="diagonal")
-    project.define_technology_layer("metal", "capacitor", 0, "Nb",
-                                    fill_type="diagonal")
-    project.define_technology_layer("metal", "feedline", 0, "Nb",
-                                    fill_type="diagonal")
 
     # Add the geometry
     project.add_gdstk_cell("metal", cap_geom, layer=0, tech_layer="capacitor")
     project.add_gdstk_cell("metal", ind_geom, layer=0, tech_layer="inductor")
-    project.add_gdstk_cell("metal", feed_geom, layer=0, tech_layer="feedline")
-
-    # Add ports
-    project.add_port("standard", 1, x=ground1_width + gap + center_width / 2, y=0,
-                     resistance=50)
-    project.add_port("standard", 2, x=ground1_width + gap + center_width / 2, y=height,
-                     resistance=50)
-    project.add_output_file("touchstone2")
 
     # Create the file name and raise an error if it's already been simulated.
-
+    simulation_file = None
     if save:
         directory = Path(__file__).parent.absolute()
         simulation_file = directory / folder / f"{name}.son"
         output_file = Path(simulation_file.parent
                            / (simulation_file.stem + ".ts"))
-        log.info(f"Simulating {simulation_file}")
-        if output_file.is_file() and not overwrite:
+
+        # With a cache the result is looked up by its inputs instead of its name.
+        key = None
+        cached = False
+        if cache is not None:
+            key = simulation_key([("capacitor", cap_geom), ("inductor", ind_geom), ("feedline", feed_geom)],
+                                 epsilon=epsilon, dx=dx, dy=dy, height=height, center_width=center_width,
+                                 gap=gap, sweep="single" if single_freq else "abs", f1=f1,
+                                 f2=None if single_freq else f2)
+            cached = run and cache.restore(key, output_file)
+        elif output_file.is_file() and not overwrite:
             raise IOError(f"{output_file} already exists")
 
         # Create the sonnet file and run.
-        project.make_sonnet_file(simulation_file)
+        if not cached:
+            log.info(f"Simulating {simulation_file}")
+            if key is None:  # keys left by an earlier cached run would describe other inputs
+                clear_keys(output_file)
+            project.make_sonnet_file(simulation_file)
+            if run:
+                frequencies = None  # only known from the output of em
+                if em_runner:
+                    from runner import run_em, analysed_frequencies  # delay psutil import
+                    frequencies = analysed_frequencies(run_em(simulation_file, timeout=timeout, logger=log))
+                else:
+                    project.run()
+                if key is not None:
+                    cache.store(key, output_file)
+                if frequencies:
+                    write_solved(output_file, key, frequencies)
+
+        # Post-process the result, e.g. postprocess=[fit_result, plot_fit].
+        # Each step is called with the .son file and a dictionary that the
+        # steps share and that is returned through the 'results' keyword.
         if run:
-            project.run()
+            results = kwargs.get('results', {})
+            for step in kwargs.get('postprocess', ()):
+                step(simulation_file, results)
 
     return project, simulation_file
 
 
+def fit_result(simulation_file, results):
+    # fit the whole touchstone file of a simulation
+    import loopfit as lf  # delay loopfit import
+    f, i, q = lf.load_touchstone(Path(simulation_file).with_suffix(".ts"))
+    guess = lf.guess(f, i, q, phase0=0, phase1=0)
+    results['fit'] = lf.fit(f, i, q, **guess)
+    results['data'] = f, i, q
+    log.info(results['fit']['summary'])
+
+
+def plot_fit(simulation_file, results):
+    # plot the data and the fit in the IQ plane (matplotlib is only imported here)
+    from matplotlib import pyplot as plt  # delay pyplot import
+    import loopfit as lf
+    if 'fit' not in results:
+        fit_result(simulation_file, results)
+    f, i, q = results['data']
+    model = lf.model(f, **results['fit'])
+    plt.plot(i, q, 'o', markersize=2, label='data')
+    plt.plot(model.real, model.imag, label='fit')
+    plt.legend()
+    plt.axis('equal')
+
+
+def export_current(simulation_file, results):
+    # export the current density at the fitted resonance frequency
+    from current import export_current_density
+    if 'fit' not in results:
+        fit_result(simulation_file, results)
+    simulation_file = Path(simulation_file)
+    f0 = results['fit']['f0']
+    export_current_density(folder=simulation_file.parent, xml_name=simulation_file.stem,
+                           csv_name=f"{simulation_file.stem}.csv", son_label=simulation_file.name,
+                           frequency=str(int(round(f0, 4) * 10**9)))
+
+
 # if __name__ == "__main__":
 #     logging.basicConfig(level='INFO')  # spits information out into the terminal
 #
@@ -0,0 +1,70 @@
+import logging
+import numpy as np
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+class Surrogate:
+    # Least-squares model of the simulated resonators used to choose the next
+    # pixel to simulate. The capacitance is linear in the finger fill, so
+    # 1 / f0**2 is modelled as linear in the fill and coupling length, and
+    # log(Qc) as a low order polynomial in both. More terms are used as more
+    # results are added.
+    def __init__(self):
+        self.fill = []
+        self.length = []
+        self.f0 = []
+        self.qc = []
+
+    def __len__(self):
+        return len(self.fill)
+
+    def add(self, fill, length, f0, qc):
+        self.fill.append(float(fill))
+        self.length.append(float(length))
+        self.f0.append(float(f0))
+        self.qc.append(float(qc))
+
+    def _scales(self):
+        fill_scale = np.max(np.abs(self.fill)) or 1.
+        length_scale = np.max(np.abs(self.length)) or 1.
+        return fill_scale, length_scale
+
+    def _features(self, fill, length, terms):
+        fill_scale, length_scale = self._scales()
+        x = np.asarray(fill, dtype=float) / fill_scale
+        y = np.asarray(length, dtype=float) / length_scale
+        x, y = np.broadcast_arrays(x, y)
+        columns = [np.ones_like(x), x, y, y**2, x * y][:terms]
+        return np.stack(columns, axis=-1)
+
+    def _solve(self, target, terms):
+        a = self._features(self.fill, self.length, terms)
+        coefficients, *_ = np.linalg.lstsq(a, target, rcond=None)
+        return coefficients
+
+    def predict(self, fill, length):
+        # returns (f0, qc) or None if there are not enough results yet
+        n = len(self)
+        if n < 2:
+            return None
+        f0_terms = min(n, 3)
+        qc_terms = 5 if n >= 8 else min(n, 3)
+        f0_coefficients = self._solve(1 / np.square(self.f0), f0_terms)
+        qc_coefficients = self._solve(np.log(self.qc), qc_terms)
+        f0 = 1 / np.sqrt(self._features(fill, length, f0_terms) @ f0_coefficients)
+        qc = np.exp(self._features(fill, length, qc_terms) @ qc_coefficients)
+        return f0, qc
+
+    def suggest(self, fill, length_array, qc_target):
+        # Index of the length predicted to be closest to the Qc target. The Qc
+        # model has no length term before the third result, so nothing is
+        # suggested until then.
+        if len(self) < 3:
+            return None
+        prediction = self.predict(fill, length_array)
+        _, qc = prediction
+        index = int(np.nanargmin(np.abs(np.log(qc / qc_target))))
+        log.debug(f"fill {fill:g}: surrogate suggests length {length_array[index]:g} (qc = {qc[index]:g})")
+        return index